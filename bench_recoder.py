@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""Benchmarks of what recoder.py itself costs per job - progress parsing, probing, stream selection and
+batch scheduling - using stand-in ffmpeg/ffprobe executables so no real media (or ffmpeg) is needed.
+
+The results are printed as JSON (or written to --output), and compared against a previous run with --compare.
+"""
+
+import argparse, contextlib, io, json, os, resource, stat, sys, tempfile, time
+import recoder
+
+# Stand-in for ffmpeg: writes BENCH_LINES lines of stats to stderr (or blocks to the -progress pipe:N) at
+# BENCH_RATE lines per second (0 being as fast as possible), creates the output file and exits with BENCH_EXIT
+FAKE_FFMPEG = r'''#!/usr/bin/env python3
+import os, sys, time
+argv = sys.argv
+lines = int(os.environ.get('BENCH_LINES', '1000'))
+rate = float(os.environ.get('BENCH_RATE', '0'))
+output = argv[-1]
+if output not in ('-', 'pipe:1') and '%' not in output:
+    open(output, 'wb').close()
+err = sys.stderr.buffer
+err.write(b'Input #0, mpegts, from \'input.m2t\':\n  Duration: 01:00:00.00, start: 1.400000, bitrate: 4000 kb/s\n')
+progress = '-progress' in argv
+out = os.fdopen(int(argv[argv.index('-progress') + 1].split(':')[1]), 'wb') if progress else sys.stdout.buffer
+for i in range(lines):
+    seconds = 3600 * (i + 1) // lines
+    if progress:
+        out.write(('frame=%d\nfps=25.00\nstream_0_0_q=-1.0\nbitrate=3519.0kbits/s\ntotal_size=%d\nout_time_us=%d\n'
+                   'out_time_ms=%d\nout_time=00:00:00.000000\ndup_frames=0\ndrop_frames=0\nspeed=1.25x\nprogress=%s\n'
+                   % (i * 25, i * 4096, seconds * 1000000, seconds * 1000000, 'end' if i == lines - 1 else 'continue')).encode())
+    else:
+        err.write(('frame=%5d fps=25 q=-1.0 size=%8dkB time=%02d:%02d:%02d.00 bitrate=3519.0kbits/s speed=1.25x    \r'
+                   % (i * 25, i * 4, seconds // 3600, seconds % 3600 // 60, seconds % 60)).encode())
+    if rate:
+        out.flush()
+        err.flush()
+        time.sleep(1 / rate)
+sys.exit(int(os.environ.get('BENCH_EXIT', '0')))
+'''
+
+# Stand-in for ffprobe: describes BENCH_STREAMS streams (as JSON or text, like the real one)
+FAKE_FFPROBE = r'''#!/usr/bin/env python3
+import json, os, sys
+streams = int(os.environ.get('BENCH_STREAMS', '5'))
+kinds = [('video', 'h264', 'Video: h264 (High), yuv420p, 1920x1080'), ('audio', 'aac_latm', 'Audio: aac_latm (HE-AAC), 48000 Hz, stereo, fltp'),
+         ('audio', 'ac3', 'Audio: ac3, 48000 Hz, 5.1(side), fltp, 448 kb/s'), ('subtitle', 'dvb_teletext', 'Subtitle: dvb_teletext'),
+         ('subtitle', 'dvb_subtitle', 'Subtitle: dvb_subtitle')]
+if '-print_format' in sys.argv:
+    print(json.dumps({'streams': [{'index': i, 'codec_type': kinds[i % 5][0], 'codec_name': kinds[i % 5][1], 'tags': {'language': 'dan'}}
+                                  for i in range(streams)],
+                      'format': {'format_name': 'mpegts', 'duration': '3600.000000', 'start_time': '1.400000', 'size': '1800000000'}}))
+else:
+    sys.stderr.write('  Duration: 01:00:00.00, start: 1.400000, bitrate: 4000 kb/s\n')
+    for i in range(streams):
+        sys.stderr.write('    Stream #0:%d[0x%x](dan): %s\n' % (i, 0xd3 + i, kinds[i % 5][2]))
+'''
+
+
+def install_fakes(folder):
+    """Writes the stand-in executables to folder and puts it first on the PATH.
+    """
+    for name, source in [('ffmpeg', FAKE_FFMPEG), ('ffprobe', FAKE_FFPROBE)]:
+        path = os.path.join(folder, name)
+        with open(path, 'wt') as f:
+            f.write(source)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    os.environ['PATH'] = folder + os.pathsep + os.environ.get('PATH', '')
+
+
+def measure(fn):
+    """Runs fn and returns (result, wall seconds, CPU seconds of this process, CPU seconds of child processes).
+    """
+    selfBefore = resource.getrusage(resource.RUSAGE_SELF)
+    childBefore = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    result = fn()
+    wall = time.perf_counter() - start
+    selfAfter = resource.getrusage(resource.RUSAGE_SELF)
+    childAfter = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = lambda a, b: (b.ru_utime - a.ru_utime) + (b.ru_stime - a.ru_stime)
+    return (result, wall, cpu(selfBefore, selfAfter), cpu(childBefore, childAfter))
+
+
+def quiet(fn):
+    """Runs fn with stdout discarded (recoder prints names, progress and so forth).
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn()
+
+
+def bench_progress(lines, pipe):
+    os.environ['BENCH_LINES'] = str(lines)
+    job = recoder.RecodeJob('input.m2t', '-', progress_pipe=pipe)
+    code, wall, cpu, childCpu = measure(lambda: recoder.run_job_sync(job, lambda text, final: None))
+    return {'lines': lines, 'wall': wall, 'cpu': cpu, 'child_cpu': childCpu, 'lines_per_second': lines / cpu if cpu else None, 'code': code}
+
+
+def bench_parse(streams, iterations):
+    os.environ['BENCH_STREAMS'] = str(streams)
+    text = recoder.probe('input.m2t', 'text')[1]
+    data = recoder.probe('input.m2t', 'json')[1]
+    _, textWall, textCpu, _ = measure(lambda: [recoder.parse_streams(text) for _ in range(iterations)])
+    _, jsonWall, jsonCpu, _ = measure(lambda: [recoder.select_streams(recoder.parse_probe_json(data).streams) for _ in range(iterations)])
+    return {'streams': streams, 'iterations': iterations,
+            'text': {'wall': textWall, 'cpu': textCpu, 'per_second': iterations / textCpu if textCpu else None},
+            'json': {'wall': jsonWall, 'cpu': jsonCpu, 'per_second': iterations / jsonCpu if jsonCpu else None}}
+
+
+def bench_probe(inputs, folder):
+    cache = recoder.ProbeCache(os.path.join(folder, 'probe.sqlite'))
+    _, coldWall, coldCpu, coldChildCpu = measure(lambda: recoder.probe_all(inputs, 'json', cache))
+    _, warmWall, warmCpu, _ = measure(lambda: recoder.probe_all(inputs, 'json', cache))
+    cache.close()
+    return {'inputs': len(inputs),
+            'cold': {'wall': coldWall, 'cpu': coldCpu, 'child_cpu': coldChildCpu, 'per_second': len(inputs) / coldWall},
+            'warm': {'wall': warmWall, 'cpu': warmCpu, 'per_second': len(inputs) / warmWall if warmWall else None}}
+
+
+def bench_batch(inputs, folder, jobs):
+    os.environ['BENCH_LINES'] = '10'
+    args = recoder.build_parser().parse_args(['-z', '--no-probe-cache', '-j', str(jobs), '-o', os.path.join(folder, 'out', '.mkv')] + inputs)
+    os.makedirs(os.path.join(folder, 'out'), exist_ok=True)
+    journal = recoder.Journal(os.path.join(folder, 'journal.jsonl'))
+    results, wall, cpu, childCpu = measure(lambda: quiet(lambda: recoder.transcode_all(inputs, args, None, None, journal)))
+    return {'inputs': len(inputs), 'jobs': jobs, 'wall': wall, 'cpu': cpu, 'child_cpu': childCpu,
+            'cpu_per_job': cpu / len(inputs), 'failed': len([it for it in results if it[1] > 0])}
+
+
+def flatten(results, prefix=''):
+    """Flattens the nested results into a map from dotted names to numbers.
+    """
+    flat = {}
+    for key, value in results.items():
+        if (isinstance(value, dict)):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif (isinstance(value, (int, float)) and not isinstance(value, bool)):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(previous, current, threshold):
+    """Lists the timings (wall/cpu) that got slower by more than threshold (a fraction) since the previous results.
+    """
+    before = flatten(previous)
+    regressions = []
+    for key, value in flatten(current).items():
+        if (key.rsplit('.', 1)[-1] in ('wall', 'cpu', 'cpu_per_job') and before.get(key)):
+            change = (value - before[key]) / before[key]
+            if (change > threshold):
+                regressions.append((key, before[key], value, change))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the overhead of recoder.py using stand-in ffmpeg/ffprobe executables")
+    parser.add_argument("--lines", type=int, default=100000, help="Progress lines written by the stand-in ffmpeg (default 100000)")
+    parser.add_argument("--streams", type=int, default=12, help="Streams described by the stand-in ffprobe (default 12)")
+    parser.add_argument("--inputs", type=int, default=2000, help="Synthetic inputs probed and recoded (default 2000)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Jobs used for the batch benchmark (default is the number of CPUs)")
+    parser.add_argument("--output", help="Write the results (JSON) to this file instead of stdout")
+    parser.add_argument("--compare", help="Results (JSON) of a previous run to compare against - exit code is 1 if anything got slower")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown (fraction) reported as a regression (default 0.1)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='recoder-bench-') as folder:
+        install_fakes(folder)
+        inputs = []
+        for i in range(args.inputs):
+            input = os.path.join(folder, 'input{:05d}.m2t'.format(i))
+            open(input, 'wb').close()
+            inputs.append(input)
+        os.environ['BENCH_STREAMS'] = str(args.streams)
+        results = {
+            'python': sys.version.split()[0],
+            'progress_stderr': bench_progress(args.lines, False),
+            'progress_pipe': bench_progress(args.lines, True),
+            'parse_streams': bench_parse(args.streams, 1000),
+            'probe': bench_probe(inputs, folder),
+            'batch': bench_batch(inputs, folder, args.jobs),
+        }
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if (args.output):
+        with open(args.output, 'wt') as f:
+            f.write(text+'\n')
+    else:
+        print(text)
+
+    if (args.compare):
+        with open(args.compare, 'rt') as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        for key, before, after, change in regressions:
+            print("Regression: {} {:.4f} -> {:.4f} (+{:.0%})".format(key, before, after, change), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
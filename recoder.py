@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
-import argparse, subprocess, re, math, sys, os, tempfile
+import argparse, asyncio, contextlib, subprocess, re, math, sys, os, tempfile, threading, concurrent.futures, collections, json, hashlib, sqlite3, time, glob, shutil, select, struct, heapq, fnmatch, ctypes, ctypes.util
 
-def output_path(output, input):
+def output_path(output, input, playlist=None):
     """Based on given output and input this generates the actual output path.
+
+    If playlist is given (e.g. index.m3u8) the output is a folder of segments - resolved as the output file would
+    be, minus the extension - and the path of the playlist in that folder is returned. '-' (stdout) is kept as is.
     """
+    if (output == '-'):
+        return output
+    if (playlist):
+        return os.path.join(os.path.splitext(output_path(output, input))[0], playlist)
     root = ''
                 
     if(output.startswith('+')):
@@ -35,23 +42,34 @@ def output_path(output, input):
     return output
     
 
-def parse_streams(probeOutput, verbose=False):
-    """List the suggested streams.
-    
-    Given output from ffprobe this will print (if verbose) all streams and return a map
-    with best suggestions - this will be one h264 video stream, one or two audio streams
-    (stereo and 5.1 audio streams) and one dvb_subtitle stream (though not ones marked for
-    hearing impaired)
-    
-    The maps returned have the following keys:
-    type:    (video|audio|subtitle)<br>
-    index:   integer<br>
-    desc: comment related to stream - here for user-friendliness
-    
-    Returns a list of maps.
+# A stream of the probed input - index is the stream index (integer), type is (video|audio|subtitle|data|...),
+# codec is the codec name, disposition a tuple of the disposition flags set (e.g. 'default', 'hearing_impaired'),
+# desc is a human-readable description, profile, level and field_order are as reported by ffprobe; fields not known are None
+Stream = collections.namedtuple('Stream', ['index', 'type', 'codec', 'language', 'disposition', 'desc',
+                                           'width', 'height', 'pix_fmt', 'frame_rate', 'time_base',
+                                           'sample_rate', 'channels', 'channel_layout', 'duration',
+                                           'profile', 'level', 'field_order'], defaults=[None, None, None])
+
+# The result of probing an input - duration and start_time (the timestamp of the start of the input) are in seconds (None if unknown)
+Probe = collections.namedtuple('Probe', ['streams', 'duration', 'format_name', 'size', 'bit_rate', 'start_time'])
+
+# Rules deciding which streams are suggested - a stream is suggested if a rule of the same type matches it:
+# codecs:    codec name must start with one of these<br>
+# languages: language must be one of these (None being a stream without language)<br>
+# exclude:   none of these disposition flags must be set<br>
+# desc:      include the description in the suggestion
+DEFAULT_RULES = [
+    {'type': 'video', 'codecs': ['h264']},
+    {'type': 'audio', 'codecs': ['aac', 'ac3', 'mp3'], 'languages': [None, 'dan', 'eng'], 'desc': True},
+    {'type': 'subtitle', 'codecs': ['dvb_subtitle', 'subrip'], 'exclude': ['hearing_impaired']},
+]
+
+
+def parse_probe_text(probeOutput):
+    """Parses the human-readable (stderr) output of ffprobe into a Probe.
+
+    Only the index, type, codec, language, disposition and description of the streams are known.
     """
-    
-    list = []
     # Seemingly no system when it comes to stream description, examples:
     #--- Kaffeine DVB-T (m2t):
     #Stream #0:0[0xd3]: Video: h264 (High) ([27][0][0][0] / 0x001B), yuv420p(tv, bt470bg), 704x576 [SAR 16:11 DAR 16:9], 25 fps, 50 tbr, 90k tbn, 50 tbc
@@ -68,41 +86,135 @@ def parse_streams(probeOutput, verbose=False):
     #Stream #0:0[0x1011]: Video: h264 (High) (HDMV / 0x564D4448), yuv420p, 1920x1080 [SAR 1:1 DAR 16:9], 25 fps, 25 tbr, 90k tbn, 50 tbc
     #Stream #0:1[0x1100]: Audio: ac3 (AC-3 / 0x332D4341), 48000 Hz, stereo, fltp, 256 kb/s
     #Stream #0:2[0x1200]: Subtitle: hdmv_pgs_subtitle ([144][0][0][0] / 0x0090), 1920x1080
-    streamPattern = re.compile(r'^\s*Stream #\d:(\d)(\[\w+\])?(\(.+\))?: (\w+): (.+)$')
+    streamPattern = re.compile(r'^\s*Stream #\d+:(\d+)(\[\w+\])?(\(([^)]+)\))?: (\w+): (.+)$')
+    durationPattern = re.compile(r'^\s*Duration: ([0-9]{2}:[0-9]{2}:[0-9]{2}(\.[0-9]+)?)(, start: (-?[0-9.]+))?')
     STREAM_IDX = 1
-    OPT_CODE = 2
-    AUDIO_LANG = 3
-    STREAM_CAT = 4
-    REMAINDER = 5
+    LANG = 4
+    STREAM_CAT = 5
+    REMAINDER = 6
+    streams = []
+    duration = None
+    start = None
     for it in probeOutput.splitlines():
         m = streamPattern.match(it)
         if m:
-            map = {}
-            if verbose:
-                print(it.strip())
-            switch = m.group(STREAM_CAT)
-            if switch=='Video':
-                if m.group(REMAINDER).startswith('h264'):
-                    map['type']='video'
-                    map['index']=m.group(STREAM_IDX)
-                    #map['desc']=m.group(REMAINDER)
-                    list.append(map)
-            elif switch=='Audio':                   
-                if ((not m.group(AUDIO_LANG) or m.group(AUDIO_LANG) == '(dan)' or m.group(AUDIO_LANG) == '(eng)') 
-                    and [x for x in ['aac','ac3','mp3'] if m.group(REMAINDER).startswith(x)]):
-                    map['type']='audio'
-                    map['index']=m.group(STREAM_IDX)
-                    map['desc']=m.group(REMAINDER)
-                    list.append(map)
-            elif switch=='Subtitle':
-                if (m.group(REMAINDER).startswith('dvb_subtitle') or m.group(REMAINDER).startswith('subrip')) and m.group(REMAINDER).find('hearing impaired') == -1:
-                    map['type']='subtitle'
-                    map['index']=m.group(STREAM_IDX)
-                    #map['desc']=m.group(REMAINDER)
-                    list.append(map)
+            remainder = m.group(REMAINDER)
+            disposition = []
+            if remainder.find('(default)') != -1:
+                disposition.append('default')
+            if remainder.find('hearing impaired') != -1:
+                disposition.append('hearing_impaired')
+            streams.append(Stream(int(m.group(STREAM_IDX)), m.group(STREAM_CAT).lower(), remainder.split(' ')[0].rstrip(','),
+                                  m.group(LANG), tuple(disposition), remainder,
+                                  None, None, None, None, None, None, None, None, None))
+        elif duration is None:
+            m = durationPattern.match(it)
+            if m:
+                duration = to_seconds(m.group(1))
+                start = float(m.group(4)) if m.group(4) else None
+    return Probe(streams, duration, None, None, None, start)
+
+
+def parse_probe_json(probeOutput):
+    """Parses the output of 'ffprobe -print_format json -show_streams -show_format' into a Probe.
+    """
+    def number(value, kind=float):
+        try:
+            return kind(value) if value is not None else None
+        except ValueError:
+            return None
+
+    data = json.loads(probeOutput) if probeOutput.strip() else {}
+    streams = []
+    for it in data.get('streams', []):
+        kind = it.get('codec_type', 'data')
+        codec = it.get('codec_name', 'none')
+        desc = [codec + (' ({})'.format(it['profile']) if it.get('profile') else '')]
+        if kind == 'video':
+            desc += [it.get('pix_fmt')]
+            if it.get('width'):
+                desc += ['{}x{}'.format(it['width'], it['height'])]
+        elif kind == 'audio':
+            desc += ['{} Hz'.format(it['sample_rate']) if it.get('sample_rate') else None, it.get('channel_layout'), it.get('sample_fmt')]
+            if it.get('bit_rate'):
+                desc += ['{} kb/s'.format(int(it['bit_rate']) // 1000)]
+        disposition = tuple(sorted(k for k, v in it.get('disposition', {}).items() if v))
+        if 'default' in disposition:
+            desc[-1] = desc[-1] + ' (default)' if desc[-1] else '(default)'
+        if 'hearing_impaired' in disposition:
+            desc[-1] = desc[-1] + ' (hearing impaired)' if desc[-1] else '(hearing impaired)'
+        streams.append(Stream(it.get('index'), kind, codec, it.get('tags', {}).get('language'), disposition,
+                              ', '.join(d for d in desc if d),
+                              it.get('width'), it.get('height'), it.get('pix_fmt'), it.get('r_frame_rate'), it.get('time_base'),
+                              number(it.get('sample_rate'), int), it.get('channels'), it.get('channel_layout'),
+                              number(it.get('duration')), it.get('profile'), number(it.get('level'), int), it.get('field_order')))
+    format = data.get('format', {})
+    return Probe(streams, number(format.get('duration')), format.get('format_name'),
+                 number(format.get('size'), int), number(format.get('bit_rate'), int), number(format.get('start_time')))
+
+
+def parse_probe(probeOutput, backend='text'):
+    """Parses the ffprobe output of the given backend (text|json) into a Probe.
+    """
+    return parse_probe_json(probeOutput) if backend == 'json' else parse_probe_text(probeOutput)
+
+
+def load_rules(path):
+    """Loads stream selection rules (see DEFAULT_RULES) from a JSON file holding a list of rules.
+    """
+    with open(path, 'rt') as f:
+        rules = json.load(f)
+    if (not isinstance(rules, list) or [it for it in rules if not isinstance(it, dict) or 'type' not in it]):
+        raise ValueError("'{}' must hold a list of rules, each with at least a 'type'".format(path))
+    return rules
+
+
+def select_streams(streams, rules=None, verbose=False):
+    """List the suggested streams.
+
+    Given the streams of a Probe this will print (if verbose) all streams and return a map
+    with best suggestions according to the rules (DEFAULT_RULES if none given) - per default this will
+    be one h264 video stream, one or two audio streams (stereo and 5.1 audio streams) and one
+    dvb_subtitle stream (though not ones marked for hearing impaired)
+
+    The maps returned have the following keys:
+    type:    (video|audio|subtitle)<br>
+    index:   integer<br>
+    desc: comment related to stream - here for user-friendliness
+
+    Returns a list of maps.
+    """
+    rules = DEFAULT_RULES if rules is None else rules
+    list = []
+    for it in streams:
+        if verbose:
+            print('Stream #0:{}{}: {}: {}'.format(it.index, '({})'.format(it.language) if it.language else '',
+                                                it.type.capitalize(), it.desc))
+        for rule in rules:
+            if (rule['type'] == it.type
+                and ('codecs' not in rule or [x for x in rule['codecs'] if it.codec.startswith(x)])
+                and ('languages' not in rule or it.language in rule['languages'])
+                and not [x for x in rule.get('exclude', []) if x in it.disposition]):
+                map = {'type': it.type, 'index': str(it.index)}
+                if rule.get('desc'):
+                    map['desc'] = it.desc
+                list.append(map)
+                break
     return list
 
 
+def parse_streams(probeOutput, verbose=False, rules=None):
+    """List the suggested streams given the human-readable output from ffprobe - see select_streams.
+
+    Returns a list of maps.
+    """
+    if verbose:
+        for it in probeOutput.splitlines():
+            if it.strip().startswith('Stream #'):
+                print(it.strip())
+    return select_streams(parse_probe_text(probeOutput).streams, rules)
+
+
 def concat_list(output, inputs):
     """Generates list if input files to be concatenated, as well as the final path for the output file.
     """
@@ -122,16 +234,21 @@ def concat_list(output, inputs):
     return (output,list)
 
     
-# Time format [[hh:][mm:]ss] eg. 01:05:27, or 05:00 for five minutes, or 30 for half a minute (01:90 and 2 minute and 30 seconds if so inclined)
+# Time format [[hh:][mm:]ss[.fff]] eg. 01:05:27, or 05:00 for five minutes, or 30 for half a minute (01:90 and 2 minute and 30 seconds if so inclined),
+# or 00:01:02.480 for a time with milliseconds
 def to_seconds(format):
     rev = format.split(':')
     rev.reverse()
-    return sum([int(s)*math.pow(60,idx) for idx,s in enumerate(rev)])
+    return sum([float(s)*math.pow(60,idx) for idx,s in enumerate(rev)])
 
 
 def from_seconds(secs):
-    seconds = int(secs)
-    return '{:0>2}:{:0>2}:{:0>2}'.format(seconds // 3600, (seconds % 3600) // 60, (seconds % 60))
+    millis = int(round(secs * 1000))
+    seconds = millis // 1000
+    result = '{:0>2}:{:0>2}:{:0>2}'.format(seconds // 3600, (seconds % 3600) // 60, (seconds % 60))
+    if (millis % 1000):
+        result += '.{:0>3}'.format(millis % 1000)
+    return result
 
 
 def print_name(name):
@@ -140,16 +257,2128 @@ def print_name(name):
     print('='*len(name))
 
 
-if __name__ == '__main__':
+def print_report(text, final):
+    """Default progress report - prints to the terminal, lines that aren't final are overwritten by the next one.
+    """
+    print(text, end='\n' if final else '\r')
+
+
+def threads_per_job(jobs, cpus=None):
+    """Splits the CPU budget between the given number of concurrent jobs.
+
+    Returns the number of threads each ffmpeg process should be given (at least one).
+    """
+    cpus = cpus or os.cpu_count() or 1
+    return max(1, cpus // max(1, jobs))
+
+
+def probe_command(input, backend='json'):
+    """Builds the ffprobe command for the given backend - json asks for the streams and format as JSON
+    on stdout, text relies on the human-readable description written to stderr.
+    """
+    if (backend == 'json'):
+        return ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_streams', '-show_format', input]
+    #options are for some detailed output, but getting the error streams holds the relevant info
+    return ['ffprobe', input]
+
+
+def probe(input, backend='json'):
+    """Runs ffprobe on the input and returns the exit code and the output of ffprobe (see probe_command).
+    """
+    cmd = probe_command(input, backend)
+    if (backend == 'json'):
+        proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL)
+        output = proc.stdout.read().decode('utf-8')
+        proc.stdout.close()
+    else:
+        proc = subprocess.Popen(cmd,stderr=subprocess.PIPE)
+        output = proc.stderr.read().decode('utf-8')
+        proc.stderr.close()
+    code = proc.wait()
+    return (code, output)
+
+
+# Upper bound of the total size (bytes) of the probe outputs kept in the probe cache
+PROBE_CACHE_SIZE = 64*1024*1024
+
+
+def cache_dir():
+    """The folder holding the files recoder keeps between runs (~/.cache/recoder unless XDG_CACHE_HOME is set).
+    """
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'recoder')
+
+
+class ProbeCache:
+    """On-disk (SQLite) cache of ffprobe output keyed by the path, size and modification time of the input.
+
+    When the total size of the cached output exceeds maxSize the least recently used entries are evicted.
+    The cache is meant to be used from one thread only, but every call commits so other recoders can share the file.
+    """
+
+    def __init__(self, path=None, maxSize=PROBE_CACHE_SIZE):
+        if (not path):
+            os.makedirs(cache_dir(), exist_ok=True)
+            path = os.path.join(cache_dir(), 'probe.sqlite')
+        self.maxSize = maxSize
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS probe (path TEXT, backend TEXT, size INTEGER, mtime INTEGER,"
+                        " output TEXT, used REAL, PRIMARY KEY (path, backend))")
+        self.db.commit()
+
+    @staticmethod
+    def key(input):
+        st = os.stat(input)
+        return (os.path.abspath(input), st.st_size, st.st_mtime_ns)
+
+    def get(self, input, backend):
+        """Returns the cached output for the input (None if not cached or if the input has changed since).
+        """
+        return self.get_all([input], backend).get(input)
+
+    def get_all(self, inputs, backend):
+        """Returns a map from the inputs found in the cache (and unchanged since) to their cached output - the cache
+        is not locked beyond the call, and if it cannot be read (e.g. locked by another recoder) nothing is found.
+        """
+        found = {}
+        try:
+            for input in inputs:
+                try:
+                    path, size, mtime = ProbeCache.key(input)
+                except OSError:
+                    continue
+                row = self.db.execute("SELECT output FROM probe WHERE path=? AND backend=? AND size=? AND mtime=?",
+                                      (path, backend, size, mtime)).fetchone()
+                if (row is not None):
+                    found[input] = row[0]
+            if (found):
+                with self.db:
+                    self.db.executemany("UPDATE probe SET used=? WHERE path=? AND backend=?",
+                                        [(time.time(), os.path.abspath(it), backend) for it in found])
+        except sqlite3.Error as e:
+            print("Warning: probe cache not readable ({})".format(e), file=sys.stderr)
+        return found
+
+    def put(self, input, backend, output):
+        self.put_all([(input, output)], backend)
+
+    def put_all(self, outputs, backend):
+        """Adds the (input, output) pairs to the cache in one transaction - if the cache cannot be written
+        (e.g. locked by another recoder) they are just not cached.
+        """
+        rows = []
+        for input, output in outputs:
+            try:
+                rows.append(ProbeCache.key(input) + (output, time.time()))
+            except OSError:
+                pass
+        try:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO probe (path, size, mtime, output, used, backend) VALUES (?, ?, ?, ?, ?, ?)",
+                                    [it + (backend,) for it in rows])
+        except sqlite3.Error as e:
+            print("Warning: probe cache not writable ({})".format(e), file=sys.stderr)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is within its size bound.
+        """
+        with self.db:
+            total = self.db.execute("SELECT COALESCE(SUM(LENGTH(output)), 0) FROM probe").fetchone()[0]
+            if (total > self.maxSize):
+                for path, backend, length in self.db.execute("SELECT path, backend, LENGTH(output) FROM probe ORDER BY used").fetchall():
+                    if (total <= self.maxSize):
+                        break
+                    self.db.execute("DELETE FROM probe WHERE path=? AND backend=?", (path, backend))
+                    total -= length
+
+    def close(self):
+        try:
+            self.evict()
+        except sqlite3.Error as e:
+            print("Warning: probe cache not evicted ({})".format(e), file=sys.stderr)
+        self.db.close()
+
+
+def open_probe_cache(enabled=True):
+    """Opens the default probe cache - returns None if disabled or if the cache cannot be opened.
+    """
+    if (not enabled):
+        return None
+    try:
+        return ProbeCache()
+    except (OSError, sqlite3.Error) as e:
+        print("Warning: probe cache not available ({})".format(e), file=sys.stderr)
+        return None
+
+
+def probe_all(inputs, backend='json', cache=None, jobs=None):
+    """Probes all inputs, taking what it can from the cache and running ffprobe concurrently for the rest
+    (results of successful probes are added to the cache).
+
+    Returns a map from input to the (exit code, output) as returned by probe.
+    """
+    return asyncio.run(probe_many(inputs, backend, cache, jobs))
+
+
+async def probe_async(input, backend='json'):
+    """Same as probe, but runs ffprobe as an asyncio subprocess.
+    """
+    cmd = probe_command(input, backend)
+    isJson = backend == 'json'
+    proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.DEVNULL,
+                                                stdout=asyncio.subprocess.PIPE if isJson else asyncio.subprocess.DEVNULL,
+                                                stderr=asyncio.subprocess.DEVNULL if isJson else asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    return (proc.returncode, (stdout if isJson else stderr).decode('utf-8'))
+
+
+async def probe_many(inputs, backend='json', cache=None, limit=None):
+    """Probes all inputs (see probe_all), running at most limit ffprobe processes at once.
+    """
+    cached = cache.get_all(inputs, backend) if cache else {}
+    results = {input: (0, output) for input, output in cached.items()}
+    misses = []
+    for input in inputs:
+        if (input not in results and input not in misses):
+            misses.append(input)
+    if (misses):
+        semaphore = asyncio.Semaphore(limit or min(32, (os.cpu_count() or 1) * 4))
+        async def one(input):
+            async with semaphore:
+                return await probe_async(input, backend)
+        for input, result in zip(misses, await asyncio.gather(*[one(it) for it in misses])):
+            results[input] = result
+        if (cache):
+            cache.put_all([(it, results[it][1]) for it in misses if results[it][0] == 0], backend)
+    return results
+
+
+def needs_probe(args):
+    """True if the streams should be auto-detected, i.e. if requested and not all streams are given already.
+    """
+    return args.streams and not (args.video and args.audio and args.subtitle)
+
+
+def should_probe(args):
+    """True if the inputs should be probed before recoding - to auto-detect the streams, or because the
+    duration or start time of the inputs is needed (--split-parallel, --smart-cut, --resume, --auto-tune).
+    """
+    return needs_probe(args) or args.split_parallel > 1 or args.smart_cut or args.resume or args.auto_tune
+
+
+def suggest_maps(streams, vMap=None, aMap1=None, sMap=None):
+    """Fills in the stream maps not already given from the streams suggested by parse_streams.
+
+    We'll consume max one video, two audio and one subtitle - if there are any further they are ignored.
+
+    Returns a tuple (video, audio1, audio2, subtitle).
+    """
+    aMap2 = None
+    for it in streams:
+        if(it['type'] == 'video'):
+            if (not vMap):
+                vMap = it['index']
+        elif(it['type'] == 'audio'):
+            if (not aMap1):
+                aMap1 = it['index']
+            elif (not aMap2):
+                aMap2 = it['index']
+        elif(it['type'] == 'subtitle'):
+            if (not sMap):
+                sMap = it['index']
+    return (vMap, aMap1, aMap2, sMap)
+
+
+# An output given with -o - the output (see output_path), and optionally its own video codec, profile
+# (a name, or once resolved the profile itself) and scale (ffmpeg's scale filter, e.g. 640:-2)
+Target = collections.namedtuple('Target', ['output', 'codec', 'profile', 'scale'], defaults=[None, None, None])
+
+
+def parse_target(text):
+    """Parses an -o argument - the output optionally followed by comma separated codec=, profile= and scale= settings,
+    e.g. /preview/.mp4,profile=preview,scale=640:-2.
+    """
+    parts = text.split(',')
+    settings = {}
+    while (len(parts) > 1 and re.match(r'\w+=', parts[-1])):
+        key, _, value = parts.pop().partition('=')
+        if (key not in Target._fields[1:] or not value):
+            raise ValueError("'{}={}' is not a codec, profile or scale".format(key, value))
+        settings[key] = value
+    return Target(','.join(parts), settings.get('codec'), settings.get('profile'), settings.get('scale'))
+
+
+class TargetAction(argparse.Action):
+    """Collects the targets of the -o options (see parse_target) in args.targets - args.output is the output of the first.
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        namespace.targets = (namespace.targets or []) + [values]
+        namespace.output = namespace.targets[0].output
+
+
+# Encode profiles for --transcode - vcodec (default h264), preset, crf or bitrate (e.g. '4M'), tune and
+# threads; the values not given are left to ffmpeg. More profiles can be given in the config file (see load_config)
+PROFILES = {
+    'default': {},
+    'fast': {'preset': 'veryfast', 'crf': 23},
+    'archive': {'preset': 'slow', 'crf': 20},
+    'preview': {'preset': 'veryfast', 'crf': 28, 'tune': 'fastdecode'},
+}
+
+# The presets tried by --auto-tune (from fastest to slowest)
+AUTO_TUNE_PRESETS = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow']
+
+
+def load_config(path=None):
+    """Loads the JSON config file - default is ~/.config/recoder/config.json (if it exists). It may hold
+    'profiles' (a map from name to profile, see PROFILES) and the name of the default 'profile'.
+
+    Returns a map (empty if there is no config file).
+    """
+    if (not path):
+        path = os.path.join(os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config'), 'recoder', 'config.json')
+        if (not os.path.exists(path)):
+            return {}
+    with open(path, 'rt') as f:
+        config = json.load(f)
+    if (not isinstance(config, dict) or not isinstance(config.get('profiles', {}), dict)):
+        raise ValueError("'{}' must hold a map, with 'profiles' being a map from name to profile".format(path))
+    return config
+
+
+def find_profile(name=None, config=None):
+    """Returns the named profile (the profile given by the config or 'default' if no name is given) -
+    the profiles of the config take precedence over PROFILES.
+    """
+    config = config or {}
+    profiles = dict(PROFILES)
+    profiles.update(config.get('profiles', {}))
+    name = name or config.get('profile') or 'default'
+    if (name not in profiles):
+        raise ValueError("Unknown profile '{}' (known profiles are {})".format(name, ', '.join(sorted(profiles))))
+    return profiles[name]
+
+
+def profile_options(profile):
+    """The options for the video encoder given by the profile (see PROFILES).
+    """
+    options = []
+    for key, option in [('preset', '-preset'), ('crf', '-crf'), ('bitrate', '-b:v'), ('tune', '-tune'), ('threads', '-threads')]:
+        if (profile.get(key) is not None):
+            options += [option, str(profile[key])]
+    return options
+
+
+def video_encoding(args, target=None):
+    """The video codec and encoder options of the target (see parse_target - default is the first output) given
+    by the command line arguments - the codec is copy unless transcoding, or the target has a codec, profile or scale.
+    """
+    target = target or (args.targets[0] if args.targets else Target(args.output))
+    if (target.codec == 'copy' or not (args.transcode or target.codec or target.profile or target.scale)):
+        return ('copy', [])
+    profile = target.profile or args.profile
+    profile = profile if isinstance(profile, dict) else find_profile(profile)
+    options = profile_options(profile)
+    if (target.scale):
+        options += ['-vf', 'scale=' + target.scale]
+    return (target.codec or profile.get('vcodec', 'h264'), options)
+
+
+def without_option(options, option):
+    """The options without the given option (and its value).
+    """
+    result = []
+    skip = False
+    for it in options:
+        if (skip):
+            skip = False
+        elif (it == option):
+            skip = True
+        else:
+            result.append(it)
+    return result
+
+
+def sample_points(duration, samples, length):
+    """The start times (seconds) of the given number of samples of the given length spread evenly over the duration.
+    """
+    if (duration <= samples * length):
+        return [0]
+    return [duration * (i + 1) / (samples + 1) - length / 2 for i in range(samples)]
+
+
+def pick_preset(results, target):
+    """Picks the fastest preset whose bitrate (kbits/s) is within the target - or the one with the lowest
+    bitrate if none is. results is a list of (preset, seconds, kbits/s).
+    """
+    within = [it for it in results if it[2] <= target]
+    if (within):
+        return min(within, key=lambda it: it[1])[0]
+    return min(results, key=lambda it: it[2])[0]
+
+
+def auto_tune(input, vMap, videoCodec, options, duration, target, begin=0, report=None, samples=3, length=10, stats=None):
+    """Encodes samples of the video of the input with each of AUTO_TUNE_PRESETS and picks the fastest
+    preset that meets the target bitrate (kbits/s, see pick_preset). The CPU time of the samples is added to stats (if given).
+
+    Returns the preset (None if no sample could be encoded).
+    """
+    report = report or print_report
+    options = without_option(options, '-preset')
+    results = []
+    folder = tempfile.mkdtemp(prefix='recoder-tune-')
+    try:
+        sample = os.path.join(folder, 'sample.mkv')
+        for preset in AUTO_TUNE_PRESETS:
+            seconds = 0
+            bits = 0
+            encoded = 0
+            for start in sample_points(duration, samples, length):
+                cmd = ffmpeg_command(input, sample, (vMap, None, None, None), videoCodec, from_seconds(begin + start),
+                                     from_seconds(min(length, duration)), videoOptions=['-preset', preset] + options)
+                before = time.perf_counter()
+                if (call(cmd, stats) > 0):
+                    break
+                seconds += time.perf_counter() - before
+                bits += os.path.getsize(sample) * 8
+                encoded += min(length, duration)
+            else:
+                kbits = bits / encoded / 1000
+                report("Preset {:.<10}: {:6.2f}s {:8.1f}kbits/s".format(preset, seconds, kbits), True)
+                results.append((preset, seconds, kbits))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return pick_preset(results, target) if results else None
+
+
+def ffmpeg_command(input, output, maps, videoCodec='copy', begin=None, period=None, threads=None, videoOptions=None, outputOptions=None):
+    """Builds the ffmpeg command for recoding the input to the output (allowing to overwrite existing output).
+
+    maps is a tuple (video, audio1, audio2, subtitle) as returned by suggest_maps, videoOptions are
+    options for the video encoder (see profile_options), outputOptions go right before the output (see stream_options).
+    """
+    cmd = ["ffmpeg",  "-y"]
+    if (begin):
+        cmd.append("-ss")
+        cmd.append(begin)
+    cmd.append("-i")
+    cmd.append(input)
+    return cmd + output_arguments(output, maps, videoCodec, period, threads, videoOptions, outputOptions)
+
+
+def output_arguments(output, maps, videoCodec='copy', period=None, threads=None, videoOptions=None, outputOptions=None):
+    """The part of the ffmpeg command (see ffmpeg_command) writing one output - ffmpeg takes several of these
+    after the input, and decodes the input just once for all of them.
+    """
+    vMap, aMap1, aMap2, sMap = maps
+    cmd = []
+    if (vMap):
+        cmd.append("-map")
+        cmd.append("0:{}".format(vMap))
+        cmd.append("-vcodec")
+        cmd.append(videoCodec)
+        if (videoOptions and videoCodec != 'copy'):
+            cmd += videoOptions
+    if (aMap1):
+        cmd.append("-map")
+        cmd.append("0:{}".format(aMap1))
+        cmd.append("-acodec")
+        cmd.append("copy")
+    if (aMap2):
+        cmd.append("-map")
+        cmd.append("0:{}".format(aMap2))
+        cmd.append("-acodec")
+        cmd.append("copy")
+    if (sMap):
+        cmd.append("-map")
+        cmd.append("0:{}".format(sMap))
+        cmd.append("-scodec")
+        cmd.append("copy")
+    if (period):
+        cmd.append("-t")
+        cmd.append(period)
+    if (threads):
+        cmd.append("-threads")
+        cmd.append(str(threads))
+    if (outputOptions):
+        cmd += outputOptions
+    cmd.append(output)
+    return cmd
+
+
+# Description of a single ffmpeg run - maps is a tuple (video, audio1, audio2, subtitle) as for ffmpeg_command,
+# begin and period are timestamps (see to_seconds), progress_pipe makes ffmpeg report progress on a pipe,
+# output_options go right before the output ('-' being stdout), renditions are further outputs written by the same run,
+# destinations are the paths the outputs are moved to once done when written elsewhere first (e.g. the scratch folder)
+RecodeJob = collections.namedtuple('RecodeJob', ['input', 'output', 'maps', 'video_codec', 'video_options',
+                                                 'begin', 'period', 'threads', 'progress_pipe', 'output_options', 'renditions',
+                                                 'destinations'],
+                                   defaults=[(None, None, None, None), 'copy', None, None, None, None, False, None, (), ()])
+
+# A further output of a RecodeJob - same streams and period as the job, but its own video codec and options
+Rendition = collections.namedtuple('Rendition', ['output', 'video_codec', 'video_options', 'output_options'],
+                                   defaults=['copy', None, None])
+
+
+def build_command(job, progressFd=1):
+    """Builds the ffmpeg command running the job (see ffmpeg_command), writing the output and then each of the
+    renditions - with -progress on the pipe progressFd if job.progress_pipe.
+    """
+    cmd = ffmpeg_command(job.input, job.output, job.maps, job.video_codec, job.begin, job.period, job.threads,
+                         job.video_options, job.output_options)
+    for it in job.renditions:
+        cmd += output_arguments(it.output, job.maps, it.video_codec, job.period, job.threads, it.video_options, it.output_options)
+    if (job.progress_pipe):
+        cmd = cmd[:1] + ['-progress', 'pipe:{}'.format(progressFd), '-nostats'] + cmd[1:]
+    return cmd
+
+
+def wait_child(proc, stats=None):
+    """Waits for the process to end and adds the CPU time (seconds) it used to stats['cpu'] (if stats given) -
+    the resource usage of just this child, so it is right even when several jobs run at once.
+
+    Returns the exit code.
+    """
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if (stats is not None):
+        stats['cpu'] = stats.get('cpu', 0) + usage.ru_utime + usage.ru_stime
+    return proc.returncode
+
+
+def parse_stats_line(line):
+    """Parses frame, fps, speed and time (seconds) from an ffmpeg stats line (the ones reported on stderr).
+
+    Returns a map with the values found.
+    """
+    stats = {}
+    for key, pattern, kind in [('frame', r'frame=\s*(\d+)', int), ('fps', r'fps=\s*([0-9.]+)', float),
+                               ('speed', r'speed=\s*([0-9.]+)x', float), ('time', r'time=\s*([0-9:.]+)', to_seconds)]:
+        m = re.search(pattern, line)
+        if (m):
+            try:
+                stats[key] = kind(m.group(1))
+            except ValueError:
+                pass
+    return stats
+
+
+# One snapshot of the -progress output - out_time_us and total_size are integers (None if ffmpeg reports N/A),
+# fps, speed (factor of real time) and bitrate (kbits/s) are floats
+Progress = collections.namedtuple('Progress', ['frame', 'fps', 'bitrate', 'total_size', 'out_time_us', 'speed', 'done'])
+
+
+class ProgressParser:
+    """Incremental parser of the key=value blocks written by ffmpeg's -progress option.
+
+    Feed it chunks of bytes as they are read from the pipe - each complete block (terminated by a
+    'progress=continue' or 'progress=end' line) is returned as a Progress tuple.
+    """
+
+    def __init__(self):
+        self.pending = b''
+        self.fields = {}
+
+    def feed(self, data):
+        """Parses the given chunk and returns a (possibly empty) list of completed Progress blocks.
+        """
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop()
+        result = []
+        for it in lines:
+            key, sep, value = it.strip().partition(b'=')
+            if (not sep):
+                continue
+            key = key.decode('ascii', 'replace')
+            value = value.decode('ascii', 'replace').strip()
+            if (key == 'progress'):
+                result.append(self.snapshot(value == 'end'))
+                self.fields = {}
+            else:
+                self.fields[key] = value
+        return result
+
+    def snapshot(self, done):
+        f = self.fields
+        outTime = ProgressParser.number(f.get('out_time_us', f.get('out_time_ms')), int)
+        return Progress(ProgressParser.number(f.get('frame'), int),
+                        ProgressParser.number(f.get('fps'), float),
+                        ProgressParser.number(f.get('bitrate'), float, 'kbits/s'),
+                        ProgressParser.number(f.get('total_size'), int),
+                        outTime,
+                        ProgressParser.number(f.get('speed'), float, 'x'),
+                        done)
+
+    @staticmethod
+    def number(value, kind, unit=''):
+        if (value is None):
+            return None
+        value = value.strip()
+        if (unit and value.endswith(unit)):
+            value = value[:-len(unit)]
+        try:
+            return kind(value)
+        except ValueError:
+            return None
+
+
+def format_progress(progress, total=None):
+    """Renders a Progress tuple in the style of ffmpeg's own stats line - prefixed with the percentage if
+    the total run time (in seconds) is known.
+    """
+    parts = []
+    if (progress.frame is not None):
+        parts.append('frame={}'.format(progress.frame))
+    if (progress.fps is not None):
+        parts.append('fps={:.1f}'.format(progress.fps))
+    if (progress.total_size is not None):
+        parts.append('size={}kB'.format(progress.total_size // 1024))
+    if (progress.out_time_us is not None):
+        seconds = progress.out_time_us / 1000000
+        parts.append('time={}.{:0>2}'.format(from_seconds(int(seconds)), int(seconds * 100) % 100))
+    if (progress.bitrate is not None):
+        parts.append('bitrate={:.1f}kbits/s'.format(progress.bitrate))
+    if (progress.speed is not None):
+        parts.append('speed={:.3g}x'.format(progress.speed))
+    line = ' '.join(parts)
+    if (total and progress.out_time_us is not None):
+        return "{:5.1f}% >> {}".format(progress.out_time_us / 10000 / total, line)
+    return line
+
+
+# Events yielded by run_job - JobStarted once ffmpeg is started, DurationEvent once ffmpeg reports the duration
+# (seconds) of the input, ProgressEvent for each progress update (percent is None if the run time is unknown,
+# line is the stats line to show, sizes are the bytes written so far to the output and each of the renditions if
+# the job has any) and finally JobResult with the exit code, the stats and the wall time (seconds)
+JobStarted = collections.namedtuple('JobStarted', ['job', 'pid'])
+DurationEvent = collections.namedtuple('DurationEvent', ['job', 'duration'])
+ProgressEvent = collections.namedtuple('ProgressEvent', ['job', 'progress', 'percent', 'line', 'sizes'], defaults=[None])
+JobResult = collections.namedtuple('JobResult', ['job', 'code', 'stats', 'wall'])
+
+
+# Number of the last lines of ffmpeg's stderr (other than progress) kept for reporting why it failed
+ERROR_LINES = 10
+
+
+def file_size(path):
+    """The size (bytes) of the file - None if it doesn't exist (yet).
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def process_cpu(pid):
+    """The CPU time (seconds) used so far by the process - None if it cannot be read (no /proc, or the process is gone).
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid), 'rb') as f:
+            fields = f.read().rsplit(b')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+async def run_job(job):
+    """Runs the job - an async generator yielding the events of the job (see JobStarted and friends) as they happen.
+
+    Progress is read in chunks from stderr, or from the -progress pipe if job.progress_pipe (see ProgressParser),
+    in which case stderr is only read for the duration of the input. The pipe is stdout, unless the output goes
+    to stdout ('-') - then it is a pipe of its own passed on to ffmpeg. The stats of the JobResult hold the final
+    frame, fps, speed and time of the output, the duration of the input and the CPU time of ffmpeg (sampled
+    from /proc with each progress update, as asyncio reaps the process itself) - and if ffmpeg failed the last
+    lines it wrote to stderr (errors).
+
+    Closing the generator before the end kills ffmpeg.
+    """
+    stats = {}
+    total = to_seconds(job.period) if job.period else None
+    last = None
+    errors = collections.deque(maxlen=ERROR_LINES)
+    start = time.perf_counter()
+    readFd, writeFd = os.pipe() if job.progress_pipe and job.output == '-' else (None, None)
+    try:
+        proc = await asyncio.create_subprocess_exec(*build_command(job, 1 if writeFd is None else writeFd), stdin=asyncio.subprocess.DEVNULL,
+                                                    stdout=asyncio.subprocess.PIPE if job.progress_pipe and writeFd is None else None,
+                                                    stderr=asyncio.subprocess.PIPE, pass_fds=() if writeFd is None else (writeFd,))
+    except OSError:
+        if (writeFd is not None):
+            os.close(readFd)
+        raise
+    finally:
+        if (writeFd is not None):
+            os.close(writeFd)
+    progressReader = proc.stdout
+    transport = None
+    if (readFd is not None):
+        progressReader = asyncio.StreamReader()
+        transport, _ = await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(progressReader),
+                                                                           os.fdopen(readFd, 'rb'))
+    events = asyncio.Queue()
+    events.put_nowait(JobStarted(job, proc.pid))
+
+    def sample():
+        cpu = process_cpu(proc.pid)
+        if (cpu is not None):
+            stats['cpu'] = cpu
+
+    def progress(it, line):
+        nonlocal last
+        last = it
+        sample()
+        percent = it.out_time_us / 10000 / total if total and it.out_time_us is not None else None
+        sizes = tuple(file_size(path) for path in [job.output] + [r.output for r in job.renditions]) if job.renditions else None
+        events.put_nowait(ProgressEvent(job, it, percent, line, sizes))
+
+    async def readErrors():
+        nonlocal total
+        dur = re.compile(r'Duration: ([0-9]{2}:[0-9]{2}:[0-9]{2}(?:\.[0-9]+)?)')
+        seen = False
+        pending = b''
+        while True:
+            data = await proc.stderr.read(65536)
+            #split on '\r' as well - ffmpeg rewrites its stats line
+            lines = re.split(rb'[\r\n]', pending + data)
+            pending = lines.pop() if data else b''
+            for it in lines:
+                line = it.decode('utf-8', 'replace')
+                m = dur.search(line) if not seen else None
+                if (m):
+                    seen = True
+                    stats['duration'] = to_seconds(m.group(1))
+                    total = total or stats['duration']
+                    events.put_nowait(DurationEvent(job, stats['duration']))
+                elif (not job.progress_pipe and 'time=' in line):
+                    found = parse_stats_line(line)
+                    if ('time' in found):
+                        progress(Progress(found.get('frame'), found.get('fps'), None, None, int(found['time'] * 1000000),
+                                          found.get('speed'), False), line)
+                elif (line.strip()):
+                    errors.append(line.strip())
+            if not data:
+                break
+
+    async def readProgress():
+        parser = ProgressParser()
+        while True:
+            data = await progressReader.read(65536)
+            if not data:
+                break
+            for it in parser.feed(data):
+                progress(it, format_progress(it))
+
+    async def pump():
+        try:
+            await asyncio.gather(readErrors(), *([readProgress()] if job.progress_pipe else []))
+        finally:
+            events.put_nowait(None)
+
+    pumping = asyncio.ensure_future(pump())
+    try:
+        while True:
+            event = await events.get()
+            if (event is None):
+                break
+            yield event
+        await pumping
+        sample()
+        code = await proc.wait()
+    finally:
+        if (proc.returncode is None):
+            proc.kill()
+            await proc.wait()
+        pumping.cancel()
+        if (transport):
+            transport.close()
+    if (last):
+        for key, value in [('frame', last.frame), ('fps', last.fps), ('speed', last.speed),
+                           ('time', last.out_time_us / 1000000 if last.out_time_us is not None else None)]:
+            if (value is not None):
+                stats[key] = value
+    if (code != 0):
+        stats['errors'] = list(errors)
+    yield JobResult(job, code, stats, time.perf_counter() - start)
+
+
+def io_bound(job):
+    """True if the job only copies streams - then it is bound by the disks rather than by the CPU.
+    """
+    return not job.maps[0] or all(it == 'copy' for it in [job.video_codec] + [r.video_codec for r in job.renditions])
+
+
+def job_devices(job):
+    """The devices (st_dev) the job reads from and writes to (including the destinations its outputs are moved to)
+    - sorted, and without the ones that cannot be determined.
+    """
+    outputs = [job.output] + [r.output for r in job.renditions] + list(job.destinations)
+    paths = [job.input] + [os.path.dirname(it) or '.' for it in outputs if it != '-']
+    devices = set()
+    for path in paths:
+        try:
+            devices.add(os.stat(path).st_dev)
+        except OSError:
+            pass
+    return sorted(devices)
+
+
+async def run_jobs(jobs, limit=None, deviceLimit=None, check=None, finish=None):
+    """Runs the jobs, at most limit (default all) at once, yielding the events of all of them (see run_job) as
+    they happen. Hundreds of jobs are fine - they are driven by the event loop, not by a thread each.
+
+    With deviceLimit at most that many I/O bound jobs (see io_bound) read from or write to the same device at
+    once, so copying several recordings from one spinning disk doesn't make it seek back and forth between them.
+    check (if given) is called with each job right before it starts - if it returns an exit code other than 0
+    the job isn't run, and its JobResult has that code. finish (if given) is called (in a thread of its own) with
+    the JobResult of each job while the job still holds its devices and slot, e.g. to move the outputs in place -
+    the JobResult yielded then has the exit code it returns.
+
+    Closing the generator before the end kills the running ffmpeg processes.
+    """
+    jobs = list(jobs)
+    semaphore = asyncio.Semaphore(max(1, limit or len(jobs)))
+    devices = {}
+    events = asyncio.Queue()
+
+    async def run(job):
+        try:
+            async with contextlib.AsyncExitStack() as stack:
+                #the devices are taken in order (so jobs don't deadlock) and before a slot (so jobs waiting for a disk don't hold one)
+                if (deviceLimit and io_bound(job)):
+                    for device in job_devices(job):
+                        await stack.enter_async_context(devices.setdefault(device, asyncio.Semaphore(deviceLimit)))
+                await stack.enter_async_context(semaphore)
+                code = check(job) if check else 0
+                if (code):
+                    result = JobResult(job, code, {}, 0.0)
+                    events.put_nowait(result._replace(code=await asyncio.to_thread(finish, result)) if finish else result)
+                    return
+                async for event in run_job(job):
+                    if (finish and isinstance(event, JobResult)):
+                        event = event._replace(code=await asyncio.to_thread(finish, event))
+                    events.put_nowait(event)
+        finally:
+            events.put_nowait(None)
+
+    tasks = [asyncio.ensure_future(run(job)) for job in jobs]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            event = await events.get()
+            if (event is None):
+                remaining -= 1
+            else:
+                yield event
+        for task in tasks:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def report_event(event, report=None):
+    """Passes an event of run_job on to a report callback (see print_report) - as progress lines prefixed with
+    the percentage if the run time is known (and followed by the size of each output if there are several),
+    the run time if it wasn't given, and an empty final line at the end.
+    """
+    report = report or print_report
+    if (isinstance(event, DurationEvent) and not event.job.period):
+        report("Run time: {}".format(from_seconds(event.duration)), True)
+    elif (isinstance(event, ProgressEvent)):
+        line = event.line
+        if (event.sizes):
+            #each output on its own - numbered in the order of the -o options
+            line += ' |' + ''.join(' size{}={}'.format(i + 1, '{}kB'.format(size // 1024) if size is not None else 'N/A')
+                                    for i, size in enumerate(event.sizes))
+        if (event.percent is not None):
+            report("{:5.1f}% >> {}".format(event.percent, line), False)
+        else:
+            report(line, True)
+    elif (isinstance(event, JobResult)):
+        report('', True)
+
+
+def report_failure(job, code, stats):
+    """Reports that ffmpeg failed running the job - along with the last lines ffmpeg wrote to stderr (see run_job).
+    """
+    print("Error: '{}' returned exit code '{}' while '0' was expected".format(build_command(job), code), file=sys.stderr)
+    for line in stats.get('errors', []):
+        print("  " + line, file=sys.stderr)
+
+
+def run_job_sync(job, report=None, stats=None):
+    """Runs the job (see run_job) to the end from synchronous code, passing the events on to report (see report_event).
+
+    If stats (a map) is given the stats of the job are stored in it. Returns the exit code of ffmpeg.
+    """
+    async def run():
+        async for event in run_job(job):
+            report_event(event, report)
+            if (isinstance(event, JobResult)):
+                if (stats is not None):
+                    stats.update(event.stats)
+                return event.code
+    return asyncio.run(run())
+
+
+def line_report(prefix, report=None, lock=None):
+    """Progress report for jobs running concurrently - each line is prefixed and passed on to report (default
+    print_report) as a whole line (no '\\r' rewriting) so the jobs don't garble each other, and progress only
+    when the whole percent changes so the terminal isn't flooded. lock (if given) is held while reporting.
+    """
+    report = report or print_report
+    last = [None]
+    def lineReport(text, final):
+        if (not text):
+            return
+        key = text[:3] if not final else None
+        if (key is not None and key == last[0]):
+            return
+        last[0] = key
+        if (lock):
+            with lock:
+                report(prefix + text, True)
+        else:
+            report(prefix + text, True)
+    return lineReport
+
+
+def split_points(duration, parts):
+    """The times (seconds) at which to split a recording of the given duration into parts of equal length.
+    """
+    return [duration * i / parts for i in range(1, parts)]
+
+
+def chunk_maps(maps):
+    """The maps of the streams of a chunk cut with segment_command - only the mapped streams are kept
+    in the chunks, numbered from 0 in the order video, audio1, audio2, subtitle.
+    """
+    result = []
+    index = 0
+    for it in maps:
+        if (it):
+            result.append(str(index))
+            index += 1
+        else:
+            result.append(None)
+    return tuple(result)
+
+
+def segment_command(input, pattern, maps, points, begin=None, period=None):
+    """Builds the ffmpeg command cutting the mapped streams of the input (copying them) into chunks at
+    the first keyframes after the given points (seconds, relative to begin). All streams are cut at the
+    same point so audio and subtitles stay in sync with the video of each chunk.
+    """
+    cmd = ["ffmpeg", "-y"]
+    if (begin):
+        cmd += ["-ss", begin]
+    cmd += ["-i", input]
+    for it in maps:
+        if (it):
+            cmd += ["-map", "0:{}".format(it)]
+    if (period):
+        cmd += ["-t", period]
+    cmd += ["-c", "copy", "-f", "segment", "-segment_times", ','.join('{:.3f}'.format(it) for it in points),
+            "-reset_timestamps", "1", pattern]
+    return cmd
+
+
+def call(cmd, stats=None):
+    """Runs the command (discarding its stderr) and reports an error if it fails - the CPU time of
+    the command is added to stats (see wait_child).
+
+    Returns the exit code.
+    """
+    code = wait_child(subprocess.Popen(cmd, stderr=subprocess.DEVNULL), stats)
+    if (code > 0):
+        print("Error: '{}' returned exit code '{}' while '0' was expected".format(cmd, code), file=sys.stderr)
+    return code
+
+
+def write_concat_list(listFile, files):
+    """Writes the list of files to concatenate (see concat_list) to listFile.
+    """
+    _, lines = concat_list(listFile, files)
+    with open(listFile, 'wt') as f:
+        for it in lines:
+            f.write(it+'\n')
+
+
+def concat_command(listFile, output):
+    """Builds the ffmpeg command concatenating (copying) the files listed in listFile into output.
+    """
+    return ['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', listFile, '-map', '0', '-c', 'copy', output]
+
+
+async def encode_chunks(jobs, report, stats=None):
+    """Encodes the chunks (jobs) of transcode_split all at once, each progress line prefixed with the chunk number.
+    The CPU time and frames of the chunks are added up in stats (if given).
+
+    Returns the exit codes of the chunks.
+    """
+    reports = [line_report("[{}/{}] ".format(index + 1, len(jobs)), report) for index in range(len(jobs))]
+    codes = []
+    async for event in run_jobs(jobs):
+        report_event(event, reports[jobs.index(event.job)])
+        if (isinstance(event, JobResult)):
+            if (event.code > 0):
+                report_failure(event.job, event.code, event.stats)
+            if (stats is not None):
+                for key in ['cpu', 'frame']:
+                    if (key in event.stats):
+                        stats[key] = stats.get(key, 0) + event.stats[key]
+            codes.append(event.code)
+    return codes
+
+
+def transcode_split(input, output, maps, videoCodec, args, duration, period=None, threads=None, report=None, stats=None, videoOptions=None):
+    """Recodes a single input by cutting it at keyframes into args.split_parallel chunks, encoding the
+    chunks in parallel, and finally concatenating the encoded chunks (without re-encoding) into the output.
+    The CPU time and frames of all the ffmpeg processes are summed up in stats (if given).
+
+    Returns the exit code - 0 on success, 7 if ffmpeg failed.
+    """
+    report = report or print_report
+    parts = args.split_parallel
+    _, ext = os.path.splitext(output)
+    try:
+        folder = tempfile.mkdtemp(prefix='recoder-split-', dir=os.path.dirname(output) or '.')
+    except OSError as e:
+        print("Error: cannot create folder for the chunks of '{}' ({})".format(input, e), file=sys.stderr)
+        return 7
+    try:
+        pattern = os.path.join(folder, 'chunk%03d' + ext)
+        cmd = segment_command(input, pattern, maps, split_points(duration, parts), args.begin, period)
+        if (args.dryrun):
+            print(cmd)
+        else:
+            report("Splitting into {} chunks".format(parts), True)
+            if (call(cmd, stats) > 0):
+                return 7
+        chunks = sorted(glob.glob(os.path.join(folder, 'chunk[0-9][0-9][0-9]' + ext))) if not args.dryrun else [pattern % i for i in range(parts)]
+
+        chunkThreads = max(1, threads // len(chunks)) if threads else threads_per_job(len(chunks))
+        #no period - the chunks are cut at keyframes so their lengths differ, progress is measured against the duration ffmpeg reads for each
+        jobs = [RecodeJob(chunk, os.path.join(folder, 'encoded' + os.path.basename(chunk)[5:]), chunk_maps(maps), videoCodec,
+                          videoOptions, None, None, chunkThreads, args.progress_pipe) for chunk in chunks]
+        if (args.dryrun):
+            for job in jobs:
+                print(build_command(job))
+        else:
+            codes = asyncio.run(encode_chunks(jobs, report, stats))
+            if ([code for code in codes if code > 0]):
+                return 7
+
+        listFile = os.path.join(folder, 'chunks.txt')
+        write_concat_list(listFile, [job.output for job in jobs])
+        cmd = concat_command(listFile, output)
+        if (args.dryrun):
+            print(cmd)
+            return 0
+        report("Joining {} chunks".format(len(chunks)), True)
+        return 7 if call(cmd, stats) > 0 else 0
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def keyframe_command(input, begin=0, end=None, offset=0):
+    """Builds the ffprobe command listing the time and flags of the video packets between begin and end
+    (seconds from the start of the input, which has the timestamp offset) - the keyframes are the ones flagged with K.
+    """
+    interval = '{:.3f}%{}'.format(max(0, offset + begin - 10), '{:.3f}'.format(offset + end + 10) if end is not None else '')
+    return ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-read_intervals', interval,
+            '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', input]
+
+
+def parse_keyframes(probeOutput, offset=0):
+    """Parses the output of keyframe_command into a sorted list of keyframe times (seconds from the start of
+    the input, which has the timestamp offset).
+    """
+    keyframes = []
+    for it in probeOutput.splitlines():
+        fields = it.strip().split(',')
+        if (len(fields) >= 2 and 'K' in fields[1]):
+            try:
+                keyframes.append(float(fields[0]) - offset)
+            except ValueError:
+                pass
+    return sorted(keyframes)
+
+
+def smart_cut_plan(begin, end, keyframes):
+    """Plans a smart cut of the period from begin to end (seconds, end None being the end of input) given
+    the keyframe times of the input: the part from the first to the last keyframe within the period can be
+    copied, only the partial GOPs before and after need to be encoded.
+
+    Returns a list of (start, end, copy) tuples - end None being the end of input.
+    """
+    inside = [it for it in keyframes if it >= begin - 0.001 and (end is None or it <= end + 0.001)]
+    if (not inside or (end is not None and inside[0] >= inside[-1])):
+        return [(begin, end, False)]
+    first = inside[0]
+    last = inside[-1] if end is not None else None
+    plan = []
+    if (first - begin > 0.001):
+        plan.append((begin, first, False))
+    plan.append((first, last, True))
+    if (last is not None and end - last > 0.001):
+        plan.append((last, end, False))
+    return plan
+
+
+# The encoders re-creating video like the source (the partial GOPs of a smart cut, or clips normalized for
+# concatenation) by the codec of the source, and the profiles (as named by ffprobe) they can match
+VIDEO_ENCODERS = {
+    'h264': ('libx264', {'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main', 'High': 'high',
+                         'High 10': 'high10', 'High 4:2:2': 'high422', 'High 4:4:4 Predictive': 'high444'}),
+    'hevc': ('libx265', {'Main': 'main', 'Main 10': 'main10'}),
+    'mpeg2video': ('mpeg2video', {'Simple': 'simple', 'Main': 'main', 'High': 'high', '4:2:2': '422'}),
+}
+
+# Same as VIDEO_ENCODERS for audio - None matching any profile (pcm codecs are encoded by the encoder of the same name)
+AUDIO_ENCODERS = {
+    'aac': ('aac', {'LC': 'aac_low'}),
+    'ac3': ('ac3', None),
+    'eac3': ('eac3', None),
+    'mp2': ('mp2', None),
+    'mp3': ('libmp3lame', None),
+    'opus': ('libopus', None),
+    'vorbis': ('libvorbis', None),
+    'flac': ('flac', None),
+}
+
+
+def matching_encoding(stream, profile=None):
+    """The video codec and encoder options re-creating video like the source video stream (same codec, profile,
+    level, pixel format and field order) so it can be joined with the source without re-encoding - the quality
+    is set by the encode profile (see PROFILES). Returns None if the stream cannot be matched.
+    """
+    if (not stream or stream.codec not in VIDEO_ENCODERS or stream.level is None or not stream.pix_fmt):
+        return None
+    encoder, profiles = VIDEO_ENCODERS[stream.codec]
+    if (stream.profile not in profiles):
+        return None
+    interlaced = stream.field_order not in (None, 'unknown', 'progressive')
+    topFirst = stream.field_order in ('tt', 'tb')
+    profile = profile if isinstance(profile, dict) else find_profile(profile)
+    options = ['-profile:v', profiles[stream.profile], '-pix_fmt', stream.pix_fmt]
+    if (stream.codec == 'h264'):
+        options += ['-level', '{}.{}'.format(stream.level // 10, stream.level % 10)] + profile_options(profile)
+        if (interlaced):
+            options += ['-x264-params', 'tff=1' if topFirst else 'bff=1']
+    elif (stream.codec == 'hevc'):
+        if (interlaced):
+            return None
+        options += ['-x265-params', 'level-idc={:g}'.format(stream.level / 30)] + profile_options(profile)
+    else:
+        #mpeg2video has no presets or crf, and its default bitrate is far too low for broadcast
+        options += ['-level', str(stream.level)] + (['-b:v', str(profile['bitrate'])] if profile.get('bitrate') else ['-q:v', '2'])
+        if (interlaced):
+            options += ['-flags', '+ildct+ilme', '-top', '1' if topFirst else '0']
+    return (encoder, options)
+
+
+def audio_encoding(codec, profile=None):
+    """The audio codec and encoder options re-creating audio of the codec and profile (as named by ffprobe) -
+    None if there is no encoder for it (e.g. aac_latm, or HE-AAC).
+    """
+    if (codec.startswith('pcm_')):
+        return (codec, [])
+    encoder, profiles = AUDIO_ENCODERS.get(codec, (None, None))
+    if (not encoder or (profiles is not None and profile not in profiles)):
+        return None
+    return (encoder, ['-profile:a', profiles[profile]] if profiles else [])
+
+
+def smart_cut_command(input, output, maps, begin, period=None, encoding=None):
+    """Builds the ffmpeg command writing a part of a smart cut - all the streams copied, or given the encoding
+    (video codec and options, see matching_encoding) the video encoded and the other streams copied.
+    maps are the streams mapped (stream specifiers of the input, e.g. '0' or 'a?').
+    """
+    cmd = ['ffmpeg', '-y', '-ss', begin, '-i', input]
+    for it in maps:
+        cmd += ['-map', '0:{}'.format(it)]
+    if (encoding):
+        cmd += ['-c:v', encoding[0]] + encoding[1] + ['-c:a', 'copy', '-c:s', 'copy']
+    else:
+        cmd += ['-c', 'copy']
+    if (period):
+        cmd += ['-t', period]
+    cmd.append(output)
+    return cmd
+
+
+def transcode_smart_cut(input, output, maps, args, encoding, offset=0, report=None, stats=None):
+    """Trims the input to --begin/--end by copying the GOPs in the middle and encoding only the partial GOPs
+    at the start and the end - the parts are then joined (without re-encoding) into the output.
+    maps are the streams mapped (see smart_cut_command), encoding is the video codec and options for the
+    partial GOPs (see matching_encoding).
+    The CPU time of all the ffmpeg processes is summed up in stats (if given).
+
+    Returns the exit code - 0 on success, 6 if probing the keyframes failed and 7 if ffmpeg failed.
+    """
+    report = report or print_report
+    begin = to_seconds(args.begin) if args.begin else 0
+    end = to_seconds(args.end) if args.end else None
+    cmd = keyframe_command(input, begin, end, offset)
+    proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL)
+    probeOutput = proc.stdout.read().decode('utf-8')
+    proc.stdout.close()
+    code = proc.wait()
+    if (code > 0):
+        print("Error: '{}' returned exit code '{}' while '0' was expected".format(cmd, code), file=sys.stderr)
+        return 6
+    plan = smart_cut_plan(begin, end, parse_keyframes(probeOutput, offset))
+    _, ext = os.path.splitext(output)
+    try:
+        folder = tempfile.mkdtemp(prefix='recoder-cut-', dir=os.path.dirname(output) or '.')
+    except OSError as e:
+        print("Error: cannot create folder for the parts of '{}' ({})".format(input, e), file=sys.stderr)
+        return 7
+    try:
+        parts = []
+        for index, (start, stop, copy) in enumerate(plan):
+            part = os.path.join(folder, 'part{:03d}{}'.format(index, ext))
+            period = from_seconds(stop - start) if stop is not None else None
+            cmd = smart_cut_command(input, part, maps, from_seconds(start), period, None if copy else encoding)
+            parts.append(part)
+            if (args.dryrun):
+                print(cmd)
+            else:
+                report("{} {} - {}".format('Copying' if copy else 'Encoding', from_seconds(start), from_seconds(stop) if stop is not None else 'end'), True)
+                if (call(cmd, stats) > 0):
+                    return 7
+        if (len(parts) == 1):
+            if (not args.dryrun):
+                shutil.move(parts[0], output)
+            return 0
+        listFile = os.path.join(folder, 'parts.txt')
+        write_concat_list(listFile, parts)
+        cmd = concat_command(listFile, output)
+        if (args.dryrun):
+            print(cmd)
+            return 0
+        return 7 if call(cmd, stats) > 0 else 0
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def partial_path(output):
+    """The path ffmpeg writes the output to until it is complete - a hidden file next to the output
+    (keeping the extension so ffmpeg still knows the container).
+    """
+    folder, name = os.path.split(output)
+    root, ext = os.path.splitext(name)
+    return os.path.join(folder, '.' + root + '.part' + ext)
+
+
+# Playlist written into the folder of segments by the streaming modes that have one
+STREAM_PLAYLISTS = {'hls': 'index.m3u8', 'dash': 'manifest.mpd'}
+
+# Length (seconds) of the segments of the hls and dash streaming modes
+SEGMENT_TIME = 6
+
+
+def stream_options(mode, output):
+    """The ffmpeg output options of the streaming mode - fmp4 is fragmented MP4 (readable from the first fragment,
+    so it can go to stdout or a pipe), hls and dash write segments and a playlist (see output_path) that is updated
+    as each segment is done. Returns None if not streaming.
+    """
+    if (mode == 'fmp4'):
+        return ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+    if (mode == 'hls'):
+        return ['-f', 'hls', '-hls_time', str(SEGMENT_TIME), '-hls_playlist_type', 'event',
+                '-hls_segment_filename', os.path.join(os.path.dirname(output), 'segment%05d.ts')]
+    if (mode == 'dash'):
+        return ['-f', 'dash', '-seg_duration', str(SEGMENT_TIME), '-streaming', '1', '-use_template', '1', '-use_timeline', '1']
+    return None
+
+
+def job_targets(args):
+    """The outputs asked for (see parse_target) - at least the one given by args.output.
+    """
+    return args.targets or [Target(args.output)]
+
+
+def job_output(input, args, target=None):
+    """The output of the input according to the command line arguments (see output_path) - for the target if given,
+    else for the first output. The playlist when streaming segments.
+    """
+    return output_path(target.output if target else args.output, input, STREAM_PLAYLISTS.get(args.stream))
+
+
+def scratch_path(output, scratch):
+    """The path in the scratch folder the output is written to before it is moved in place - the partial file
+    (see partial_path) prefixed with a hash of the output, so outputs of the same name in different folders don't clash.
+    """
+    return os.path.join(scratch, hashlib.sha1(os.path.abspath(output).encode('utf-8')).hexdigest()[:8] + os.path.basename(partial_path(output)))
+
+
+def write_path(input, args, target=None):
+    """The path ffmpeg writes the output of the input to - the partial file (see partial_path), in the scratch folder
+    if args.scratch, or when streaming the output itself so it can be read while it is written (creating the
+    folder of the segments if needed).
+    """
+    output = job_output(input, args, target)
+    if (not args.stream):
+        return scratch_path(output, args.scratch) if args.scratch else partial_path(output)
+    if (args.stream in STREAM_PLAYLISTS):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    return output
+
+
+def space_needed(input, period=None, duration=None):
+    """Estimate of the space (bytes) the output of the input needs - the size of the input, in proportion to
+    the period if given and the duration (seconds) of the input is known.
+    """
+    size = os.path.getsize(input)
+    if (period and duration):
+        size = size * min(1.0, to_seconds(period) / duration)
+    return size
+
+
+def check_space(input, args, period=None, probed=None):
+    """Checks that the folders the outputs of the input are written to (the scratch folder if any, and the folders
+    of the outputs) have room for them (see space_needed).
+
+    Returns the exit code - 0 if they have, 8 if not.
+    """
+    duration = parse_probe(probed[1], args.probe).duration if probed and probed[0] == 0 else None
+    try:
+        needed = space_needed(input, period, duration)
+    except OSError:
+        return 0
+    outputs = [job_output(input, args, it) for it in job_targets(args)]
+    folders = [os.path.dirname(it) or '.' for it in outputs if it != '-']
+    if (args.scratch and not args.stream):
+        folders = [args.scratch] * len(outputs) + folders
+    #outputs on the same device share its free space
+    needs = {}
+    for folder in folders:
+        try:
+            device = os.stat(folder).st_dev
+        except OSError:
+            continue
+        needs.setdefault(device, [folder, 0])[1] += needed
+    for folder, total in needs.values():
+        free = shutil.disk_usage(folder).free
+        if (free < total):
+            print("Error: not enough space for '{}' in '{}' ({:.0f} MB free, {:.0f} MB needed)".format(input, folder, free / 1e6, total / 1e6), file=sys.stderr)
+            return 8
+    return 0
+
+
+class Journal:
+    """Log (JSON lines) of the jobs started, done and failed - one line per change of state of a job.
+    """
+
+    def __init__(self, path=None):
+        if (not path):
+            os.makedirs(cache_dir(), exist_ok=True)
+            path = os.path.join(cache_dir(), 'journal.jsonl')
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, input, output, state, code=None):
+        entry = {'time': time.time(), 'input': os.path.abspath(input), 'output': os.path.abspath(output), 'state': state}
+        if (code is not None):
+            entry['code'] = code
+        with self.lock:
+            with open(self.path, 'at') as f:
+                f.write(json.dumps(entry)+'\n')
+
+
+def is_done(input, output, expected, outputDuration, tolerance=1.0):
+    """True if the output of the input has been committed already: the output must exist, be newer than
+    the input and have the expected duration (seconds, within tolerance or 1% whichever is larger).
+    """
+    try:
+        if (os.stat(output).st_mtime < os.stat(input).st_mtime):
+            return False
+    except OSError:
+        return False
+    if (expected is None or outputDuration is None):
+        return False
+    return abs(outputDuration - expected) <= max(tolerance, expected / 100)
+
+
+def completed_inputs(inputs, args, period, probes, cache=None):
+    """The inputs whose outputs already are done (see is_done) - used to skip those when resuming.
+    """
+    outputs = {}
+    for input in inputs:
+        paths = [job_output(input, args, it) for it in job_targets(args)]
+        if (all(os.path.exists(it) for it in paths)):
+            outputs[input] = paths
+    done = []
+    outputProbes = probe_all([it for paths in outputs.values() for it in paths], args.probe, cache)
+    for input, paths in outputs.items():
+        expected = to_seconds(period) if period else None
+        if (expected is None and input in probes and probes[input][0] == 0):
+            expected = parse_probe(probes[input][1], args.probe).duration
+            if (expected is not None and args.begin):
+                expected -= to_seconds(args.begin)
+        if (all(outputProbes[it][0] == 0 and is_done(input, it, expected, parse_probe(outputProbes[it][1], args.probe).duration) for it in paths)):
+            done.append(input)
+    return done
+
+
+def job_metrics(input, output, codec, code, wall, stats, size=None, inputDuration=None, period=None):
+    """Builds the metrics record of a job from what run_job gathered in stats - the wall time (seconds) of
+    the job, the size of the output (bytes) and the duration of the input (seconds) if known.
+
+    speed is the speed factor reported by ffmpeg (or else computed from the duration of the output), fps is
+    the average frames per second, bitrate is the bitrate of the output in kbits/s.
+    """
+    inputDuration = inputDuration if inputDuration is not None else stats.get('duration')
+    outputDuration = stats.get('time') or (to_seconds(period) if period else inputDuration)
+    speed = stats.get('speed')
+    if (speed is None and outputDuration and wall):
+        speed = outputDuration / wall
+    fps = stats['frame'] / wall if stats.get('frame') and wall else stats.get('fps')
+    _, container = os.path.splitext(output)
+    return {'time': time.time(), 'input': os.path.abspath(input), 'output': os.path.abspath(output),
+            'codec': codec, 'container': container.lstrip('.').lower(), 'code': code,
+            'wall': wall, 'cpu': stats.get('cpu'), 'speed': speed, 'fps': fps, 'size': size,
+            'bitrate': size * 8 / outputDuration / 1000 if size is not None and outputDuration else None,
+            'input_duration': inputDuration, 'output_duration': outputDuration}
+
+
+class Metrics:
+    """Per-job performance metrics - each record (see job_metrics) is appended as a JSON line to the log, and
+    summed up per codec and container in a Prometheus (node exporter) textfile.
+    """
+
+    def __init__(self, path=None, textfile=None):
+        self.path = path
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def record(self, entry):
+        with self.lock:
+            if (self.path):
+                with open(self.path, 'at') as f:
+                    f.write(json.dumps(entry)+'\n')
+            if (self.textfile):
+                key = (entry['codec'], entry['container'], 'ok' if entry['code'] == 0 else 'failed')
+                totals = self.totals.setdefault(key, {'jobs': 0, 'wall': 0, 'cpu': 0, 'media': 0, 'bytes': 0})
+                totals['jobs'] += 1
+                totals['wall'] += entry['wall'] or 0
+                totals['cpu'] += entry['cpu'] or 0
+                totals['media'] += (entry['output_duration'] or 0) if entry['code'] == 0 else 0
+                totals['bytes'] += entry['size'] or 0
+                totals['speed'] = entry['speed']
+                self.write_textfile()
+
+    def write_textfile(self):
+        lines = []
+        for name, field, kind, help in [('recoder_jobs_total', 'jobs', 'counter', 'Jobs recoded'),
+                                        ('recoder_wall_seconds_total', 'wall', 'counter', 'Wall time spent recoding'),
+                                        ('recoder_cpu_seconds_total', 'cpu', 'counter', 'CPU time used by ffmpeg'),
+                                        ('recoder_media_seconds_total', 'media', 'counter', 'Duration of the media recoded'),
+                                        ('recoder_output_bytes_total', 'bytes', 'counter', 'Size of the outputs written'),
+                                        ('recoder_last_speed', 'speed', 'gauge', 'Speed factor of the last job')]:
+            lines.append('# HELP {} {}.'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for (codec, container, status), totals in sorted(self.totals.items()):
+                if (totals.get(field) is not None):
+                    lines.append('{}{{codec="{}",container="{}",status="{}"}} {}'.format(name, codec, container, status, totals[field]))
+        temp = self.textfile + '.tmp'
+        with open(temp, 'wt') as f:
+            f.write('\n'.join(lines)+'\n')
+        os.replace(temp, self.textfile)
+
+
+def transcode(input, args, period=None, threads=None, report=None, probed=None, journal=None, metrics=None):
+    """Recodes a single input according to the command line arguments (see recode) - ffmpeg writes to
+    a partial file which is only renamed to the output once ffmpeg succeeds, so an output is either
+    complete or missing (see finish_job). Streaming outputs are written in place (see write_path).
+
+    Returns the exit code - 0 on success, 6 if probing failed, 7 if ffmpeg failed and 8 if there isn't room for the output.
+    """
+    output = job_output(input, args)
+    if (args.dryrun):
+        return recode(input, output, args, period, threads, report, probed)
+    record_started(input, args, journal)
+    stats = {}
+    start = time.perf_counter()
+    code = check_space(input, args, period, probed)
+    if (code == 0):
+        code = recode(input, write_path(input, args), args, period, threads, report, probed, stats)
+    return finish_outputs(input, code, args, time.perf_counter() - start, stats, period, probed, journal, metrics)
+
+
+def record_started(input, args, journal=None):
+    """Records in the journal (if given) that the job of the input has started - for each of its outputs.
+    """
+    if (journal):
+        for it in job_targets(args):
+            journal.record(input, job_output(input, args, it), 'started')
+
+
+def finish_outputs(input, code, args, wall, stats, period=None, probed=None, journal=None, metrics=None):
+    """Commits each of the outputs of a finished job (see finish_job), so one failing doesn't take the others along.
+
+    Returns the exit code - the worst of the outputs.
+    """
+    return max(finish_job(input, code, args, wall, stats, period, probed, journal, metrics, it) for it in job_targets(args))
+
+
+def finish_job(input, code, args, wall, stats, period=None, probed=None, journal=None, metrics=None, target=None):
+    """Commits the partial output of a finished job - moves it (from the scratch folder if args.scratch) to the
+    output if the job succeeded, removes it if not (streaming outputs are left as they are). The state of the job is recorded in the journal (if given), and its performance in the metrics (if given).
+
+    With several outputs (see parse_target) this is done for each target - default is the first output.
+
+    Returns the exit code - code, or 7 if the output cannot be committed.
+    """
+    output = job_output(input, args, target)
+    partial = partial_path(output)
+    staged = scratch_path(output, args.scratch) if args.scratch else None
+    if (args.stream):
+        pass
+    elif (code == 0 and not os.path.exists(staged or partial)):
+        print("Error: ffmpeg succeeded but wrote no '{}'".format(output), file=sys.stderr)
+        code = 7
+    elif (code == 0):
+        try:
+            if (staged):
+                #copied next to the output first, so the output still appears at once
+                shutil.move(staged, partial)
+            os.replace(partial, output)
+        except OSError as e:
+            print("Error: cannot move '{}' to '{}' ({})".format(staged or partial, output, e), file=sys.stderr)
+            for it in [staged, partial]:
+                if (it and os.path.exists(it)):
+                    os.remove(it)
+            code = 7
+    elif (os.path.exists(staged or partial)):
+        os.remove(staged or partial)
+    if (journal):
+        journal.record(input, output, 'done' if code == 0 else 'failed', code)
+    if (metrics):
+        size = os.path.getsize(output) if code == 0 and os.path.isfile(output) else None
+        inputDuration = parse_probe(probed[1], args.probe).duration if probed and probed[0] == 0 else None
+        metrics.record(job_metrics(input, output, video_encoding(args, target)[0], code, wall, stats, size, inputDuration, period))
+    return code
+
+
+def job_duration(input, args, period=None, probed=None):
+    """The duration (seconds) of the output of the input - the period if given, or else the duration of
+    the input (from begin). Returns None if unknown.
+    """
+    if (period):
+        return to_seconds(period)
+    code, probeOutput = probed or probe(input, args.probe)
+    duration = parse_probe(probeOutput, args.probe).duration if code == 0 else None
+    if (duration and args.begin):
+        duration -= to_seconds(args.begin)
+    return duration
+
+
+def plan_job(input, output, args, period=None, threads=None, probed=None):
+    """Describes the ffmpeg run recoding the input to the output according to the command line arguments -
+    probing the input (if not probed already) when the streams are to be auto-detected. Further outputs
+    (see parse_target) are renditions of the job.
+
+    Returns a tuple (exit code, RecodeJob) - the exit code is 6 (and the job None) if probing failed.
+    """
+    vMap = args.video
+    aMap1 = args.audio
+    aMap2 = None
+    sMap = args.subtitle
+    #if streams probe is requested but all streams are given already skip the probing
+    if (needs_probe(args)):
+        code, probeOutput = probed or probe(input, args.probe)
+        if (code > 0):
+            print("Error: '{}' returned exit code '{}' while '0' was expected".format(probe_command(input, args.probe), code), file=sys.stderr)
+            return (6, None)
+        streams = select_streams(parse_probe(probeOutput, args.probe).streams, args.rules)
+        vMap, aMap1, aMap2, sMap = suggest_maps(streams, vMap, aMap1, sMap)
+    if (args.stream):
+        #fragmented MP4 and the segments cannot carry the broadcast subtitle formats
+        sMap = None
+    videoCodec, videoOptions = video_encoding(args)
+    renditions = []
+    for target in job_targets(args)[1:]:
+        path = job_output(input, args, target) if args.dryrun else write_path(input, args, target)
+        renditions.append(Rendition(path, *video_encoding(args, target), stream_options(args.stream, path)))
+    destinations = tuple(job_output(input, args, it) for it in job_targets(args)) if args.scratch and not args.stream else ()
+    return (0, RecodeJob(input, output, (vMap, aMap1, aMap2, sMap), videoCodec, videoOptions, args.begin, period, threads,
+                         args.progress_pipe, stream_options(args.stream, output), tuple(renditions), destinations))
+
+
+def single_run(args):
+    """True if recoding an input is a single ffmpeg run, i.e. no smart cut, auto-tuning or splitting is asked for.
+    """
+    return not ((args.smart_cut and not args.transcode and (args.begin or args.end))
+                or (args.auto_tune and args.transcode) or args.split_parallel > 1)
+
+
+def recode(input, output, args, period=None, threads=None, report=None, probed=None, stats=None):
+    """Probes (if requested) and recodes a single input to the given output according to the command line arguments.
+
+    probed is the result of probing the input (as returned by probe) if it has been probed already.
+    If stats (a map) is given it is filled in with what is known about the job (see run_job).
+
+    Returns the exit code - 0 on success, 6 if probing failed and 7 if ffmpeg failed.
+    """
+    code, job = plan_job(input, output, args, period, threads, probed)
+    if (code > 0):
+        return code
+
+    report = report or print_report
+    if (args.smart_cut and not args.transcode and (args.begin or args.end)):
+        code, probeOutput = probed or probe(input, args.probe)
+        info = parse_probe(probeOutput, args.probe) if code == 0 else None
+        video = next((it for it in info.streams if it.type == 'video' and (job.maps[0] is None or str(it.index) == str(job.maps[0]))), None) if info else None
+        encoding = matching_encoding(video, args.profile)
+        if (encoding):
+            #always mapped - left to ffmpeg the streams would be re-encoded with the default encoders of the container
+            maps = [str(it) for it in job.maps if it is not None] or [str(video.index), 'a?', 's?']
+            return transcode_smart_cut(input, output, maps, args, encoding, info.start_time or 0, report, stats)
+        print("Warning: cannot match the video encoding of '{}' ({}) - not smart cutting it".format(input, video.codec if video else 'no video stream'),
+              file=sys.stderr)
+    if (args.auto_tune and args.transcode and job.maps[0]):
+        duration = job_duration(input, args, period, probed)
+        target = args.target_bitrate or (args.max_size * 8000 / duration if args.max_size and duration else None)
+        if (not duration or not target):
+            print("Warning: {} of '{}' unknown - not tuning it".format('duration' if not duration else 'target bitrate', input), file=sys.stderr)
+        elif (args.dryrun):
+            print("Auto-tuning preset for {:.1f}kbits/s".format(target))
+        else:
+            preset = auto_tune(input, job.maps[0], job.video_codec, job.video_options, duration, target,
+                               to_seconds(args.begin) if args.begin else 0, report, stats=stats)
+            if (preset):
+                report("Using preset {}".format(preset), True)
+                job = job._replace(video_options=['-preset', preset] + without_option(job.video_options, '-preset'))
+    if (args.split_parallel > 1):
+        duration = job_duration(input, args, period, probed)
+        if (duration and duration > 0):
+            return transcode_split(input, output, job.maps, job.video_codec, args, duration, period, threads, report, stats, job.video_options)
+        print("Warning: duration of '{}' unknown - not splitting it".format(input), file=sys.stderr)
+    if (args.dryrun):
+        print(build_command(job))
+        return 0
+    jobStats = {}
+    code = run_job_sync(job, report, jobStats)
+    if (stats is not None):
+        #added to the CPU time of the auto-tune samples (if any)
+        cpu = stats.get('cpu', 0) + jobStats.get('cpu', 0)
+        stats.update(jobStats)
+        if (cpu):
+            stats['cpu'] = cpu
+    if (code > 0):
+        report_failure(job, code, jobStats)
+        return 7
+    return 0
+
+
+def transcode_all(inputs, args, period=None, cache=None, journal=None, metrics=None):
+    """Recodes all inputs (see transcode_pending).
+
+    If the streams are to be auto-detected all inputs are probed (concurrently) up front. When resuming
+    the inputs already done are skipped (and reported as succeeded).
+
+    Returns a list of (input, exit code) - the skipped inputs first, then the rest in the order of the inputs.
+    """
+    probes = probe_all(inputs, args.probe, cache) if should_probe(args) else {}
+    skipped = []
+    if (args.resume):
+        done = completed_inputs(inputs, args, period, probes, cache)
+        for input in done:
+            print("Skipping '{}' - '{}' is done already".format(input, job_output(input, args)))
+        skipped = [(input, 0) for input in done]
+        inputs = [it for it in inputs if it not in done]
+    return skipped + transcode_pending(inputs, args, period, probes, journal, metrics)
+
+
+def transcode_pending(inputs, args, period, probes, journal=None, metrics=None):
+    """Recodes the inputs, running up to args.jobs ffmpeg processes at once - from one event loop (see
+    transcode_batch) when each input is a single ffmpeg run, or else from a pool of threads (see transcode).
+
+    With more than one job each line of progress is prefixed with the input name and printed
+    whole (no '\\r' rewriting) so concurrent jobs don't garble each other.
+
+    Returns a list of (input, exit code) in the order of the inputs.
+    """
+    if (single_run(args) and not args.dryrun):
+        return asyncio.run(transcode_batch(inputs, args, period, probes, journal, metrics))
+
+    jobs = max(1, args.jobs or 1)
+    if (jobs == 1 or len(inputs) == 1):
+        results = []
+        for input in inputs:
+            if (len(inputs) > 1):
+                print_name(input)
+            results.append((input, transcode(input, args, period, probed=probes.get(input), journal=journal, metrics=metrics)))
+            print('')
+        return results
+
+    lock = threading.Lock()
+    threads = threads_per_job(min(jobs, len(inputs)))
+
+    def job(input):
+        report = line_report("[{}] ".format(os.path.basename(input)), lock=lock)
+        return (input, transcode(input, args, period, threads, report, probes.get(input), journal, metrics))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(job, inputs))
+
+
+async def transcode_batch(inputs, args, period, probes, journal=None, metrics=None):
+    """Recodes the inputs (see transcode_pending) as RecodeJobs run by run_jobs - up to args.jobs at once, and
+    up to args.device_jobs copy jobs per device. Right before a job starts it is checked that there is room
+    for its outputs (see check_space), and once done the outputs are committed (see finish_outputs) by a thread
+    of its own, as moving it from the scratch folder may take a while - still holding the devices of the job,
+    so the move counts against args.device_jobs too.
+
+    Returns a list of (input, exit code) in the order of the inputs.
+    """
+    jobs = max(1, args.jobs or 1)
+    serial = jobs == 1 or len(inputs) == 1
+    threads = None if serial else threads_per_job(min(jobs, len(inputs)))
+    codes = {}
+    planned = []
+    reports = {}
+    for input in inputs:
+        code, job = plan_job(input, write_path(input, args), args, period, threads, probes.get(input))
+        if (code > 0):
+            record_started(input, args, journal)
+            codes[input] = finish_outputs(input, code, args, 0.0, {}, period, probes.get(input), journal, metrics)
+        else:
+            planned.append(job)
+            reports[input] = print_report if serial else line_report("[{}] ".format(os.path.basename(input)))
+
+    refused = set()
+    def check(job):
+        code = check_space(job.input, args, period, probes.get(job.input))
+        if (code > 0):
+            refused.add(job.input)
+        return code
+
+    def finish(result):
+        input = result.job.input
+        report_event(result, reports[input])
+        code = result.code
+        if (input in refused):
+            record_started(input, args, journal)
+        elif (code > 0):
+            report_failure(result.job, code, result.stats)
+            code = 7
+        code = finish_outputs(input, code, args, result.wall, result.stats, period, probes.get(input), journal, metrics)
+        if (serial):
+            print('')
+        return code
+
+    async for event in run_jobs(planned, jobs, args.device_jobs, check, finish):
+        input = event.job.input
+        if (isinstance(event, JobStarted)):
+            if (serial and len(inputs) > 1):
+                print_name(input)
+            record_started(input, args, journal)
+        elif (isinstance(event, JobResult)):
+            codes[input] = event.code
+        else:
+            report_event(event, reports[input])
+    return [(input, codes[input]) for input in inputs]
+
+
+class InotifyWatcher:
+    """Tells which files of a folder have been created, written, deleted or moved in or out of it - using inotify (Linux only).
+    """
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+
+    def __init__(self, folder):
+        self.folder = folder
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if (self.fd < 0):
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = (InotifyWatcher.IN_MODIFY | InotifyWatcher.IN_CLOSE_WRITE | InotifyWatcher.IN_MOVED_FROM | InotifyWatcher.IN_MOVED_TO
+                | InotifyWatcher.IN_CREATE | InotifyWatcher.IN_DELETE)
+        if (libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0):
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "inotify_add_watch failed for '{}'".format(folder))
+
+    def changes(self, timeout):
+        """Waits up to timeout seconds for changes and returns the set of paths changed.
+        """
+        paths = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if (ready):
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return paths
+            offset = 0
+            while (offset + 16 <= len(data)):
+                _, _, _, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset+16:offset+16+length].rstrip(b'\0')
+                offset += 16 + length
+                if (name):
+                    paths.add(os.path.join(self.folder, os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Same as InotifyWatcher but simply lists the folder every time (for systems without inotify) - all the files
+    are returned, and those that have gone since the last time.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.listed = set()
+
+    def changes(self, timeout):
+        time.sleep(timeout)
+        listed = set(os.path.join(self.folder, it) for it in os.listdir(self.folder))
+        gone = self.listed - listed
+        self.listed = listed
+        return listed | gone
+
+    def close(self):
+        pass
+
+
+def open_watcher(folder, polling=False):
+    """Returns an InotifyWatcher for the folder - or a PollingWatcher if inotify isn't available (or polling is requested).
+    """
+    if (not polling):
+        try:
+            return InotifyWatcher(folder)
+        except (OSError, AttributeError) as e:
+            print("Warning: inotify not available ({}) - polling '{}' instead".format(e, folder), file=sys.stderr)
+    return PollingWatcher(folder)
+
+
+class StabilityTracker:
+    """Keeps track of files being written - a file is stable once its size hasn't changed for settle seconds.
+    """
+
+    def __init__(self, settle):
+        self.settle = settle
+        self.pending = {}
+
+    def update(self, path, size, now):
+        previous = self.pending.get(path)
+        if (previous is None or previous[0] != size):
+            self.pending[path] = (size, now)
+
+    def forget(self, path):
+        self.pending.pop(path, None)
+
+    def stable(self, now):
+        """Returns (and stops tracking) the files that are stable by now - empty files are never stable.
+        """
+        ready = [path for path, (size, since) in self.pending.items() if size > 0 and now - since >= self.settle]
+        for path in ready:
+            del self.pending[path]
+        return sorted(ready)
+
+
+def queue_priority(order, mtime, size, duration=None):
+    """The priority of a file in the watch queue (lowest first) - newest first or shortest first
+    (by duration if known, or else by size).
+    """
+    if (order == 'shortest'):
+        return duration if duration is not None else size
+    return -mtime
+
+
+def file_identity(path):
+    """What tells a file apart from a later one of the same path (device, inode and modification time) - None if it doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_mtime_ns)
+
+
+def watch(folder, args, period=None, cache=None, journal=None, metrics=None):
+    """Watches the folder for new files matching args.pattern, and recodes each of them (like the batch does)
+    once they are stable, i.e. once their size hasn't changed for args.settle seconds. Files whose output is
+    done already (see completed_inputs) are skipped, also without args.resume, so a restart doesn't recode
+    the whole folder. A file deleted (or replaced) is recoded again when written anew. The files ready are
+    queued by priority (args.queue) and up to args.jobs are recoded at once. Runs until interrupted.
+
+    Returns the exit code - 0 unless the folder cannot be watched.
+    """
+    if (not os.path.isdir(folder)):
+        print("Error: '{}' is not a folder".format(folder), file=sys.stderr)
+        return 4
+    watcher = open_watcher(folder, args.poll)
+    tracker = StabilityTracker(args.settle)
+    queue = []
+    seen = {}
+    running = {}
+    jobs = max(1, args.jobs or 1)
+    threads = threads_per_job(jobs) if jobs > 1 else None
+    lock = threading.Lock()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    candidates = set(os.path.join(folder, it) for it in os.listdir(folder))
+    print("Watching '{}' for {}".format(folder, args.pattern))
+    try:
+        while True:
+            now = time.time()
+            for path in candidates | set(tracker.pending):
+                if (not fnmatch.fnmatch(os.path.basename(path), args.pattern)):
+                    continue
+                identity = file_identity(path)
+                if (identity is None):
+                    tracker.forget(path)
+                    seen.pop(path, None)
+                elif (seen.get(path) != identity):
+                    seen.pop(path, None)
+                    try:
+                        tracker.update(path, os.path.getsize(path), now)
+                    except OSError:
+                        tracker.forget(path)
+            ready = []
+            for path in tracker.stable(now):
+                identity = file_identity(path)
+                if (identity is not None):
+                    seen[path] = identity
+                    ready.append(path)
+            if (ready):
+                probes = probe_all(ready, args.probe, cache)
+                done = completed_inputs(ready, args, period, probes, cache)
+                for path in ready:
+                    if (path in done):
+                        print("Skipping '{}' - '{}' is done already".format(path, job_output(path, args)))
+                        continue
+                    code, probeOutput = probes.get(path, (1, ''))
+                    duration = parse_probe(probeOutput, args.probe).duration if code == 0 else None
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    heapq.heappush(queue, (queue_priority(args.queue, st.st_mtime, st.st_size, duration), path, probes.get(path)))
+
+            for future in [it for it in running if it.done()]:
+                path = running.pop(future)
+                try:
+                    code = future.result()
+                except Exception as e:
+                    print("Error: recoding '{}' failed ({})".format(path, e), file=sys.stderr)
+                    code = 7
+                print("{} '{}'".format('Done' if code == 0 else 'Failed ({})'.format(code), path))
+            while (queue and len(running) < jobs):
+                _, path, probed = heapq.heappop(queue)
+                name = os.path.basename(path)
+                def report(text, final, name=name):
+                    if (text and final):
+                        with lock:
+                            print("[{}] {}".format(name, text))
+                print("Recoding '{}'".format(path))
+                running[pool.submit(transcode, path, args, period, threads, report, probed, journal, metrics)] = path
+
+            candidates = watcher.changes(1.0)
+    except KeyboardInterrupt:
+        print("Stopping - waiting for {} running job(s)".format(len(running)))
+    finally:
+        watcher.close()
+        pool.shutdown(wait=True)
+    return 0
+
+
+def stream_signature(probe):
+    """The properties of the streams of a probed input that must be the same for the concat demuxer to join
+    it with other inputs without re-encoding - a tuple with a tuple per video, audio and subtitle stream.
+    """
+    signature = []
+    for it in probe.streams:
+        if (it.type == 'video'):
+            signature.append(('video', it.codec, it.width, it.height, it.pix_fmt, it.frame_rate, it.time_base, it.profile, it.level, it.field_order))
+        elif (it.type == 'audio'):
+            signature.append(('audio', it.codec, it.sample_rate, it.channels, it.channel_layout, it.profile))
+        elif (it.type == 'subtitle'):
+            signature.append(('subtitle', it.codec))
+    return tuple(signature)
+
+
+def describe_signature(signature):
+    parts = []
+    for it in signature:
+        if (it[0] == 'video'):
+            parts.append('{}{} {}x{} {} {}fps tb {}'.format(it[1], ' ({}, level {})'.format(it[7], it[8]) if it[7] else '', *it[2:7]))
+        elif (it[0] == 'audio'):
+            parts.append('{}{} {}Hz {}'.format(it[1], ' ({})'.format(it[5]) if it[5] else '', it[2], it[4] or '{} channels'.format(it[3])))
+        else:
+            parts.append(it[1])
+    return ' | '.join(parts)
+
+
+def majority_signature(signatures):
+    """The signature shared by most inputs (the first of those if there is a tie).
+    """
+    counts = collections.Counter(signatures)
+    return max(signatures, key=lambda it: counts[it])
+
+
+def signature_encodings(signature, profile=None):
+    """The codec and encoder options re-creating each stream of the signature (see matching_encoding and audio_encoding)
+    - copy for subtitles, None for the streams no encoder can match.
+    """
+    encodings = []
+    for it in signature:
+        if (it[0] == 'video'):
+            _, codec, width, height, pixFmt, frameRate, timeBase, videoProfile, level, fieldOrder = it
+            encodings.append(matching_encoding(Stream(None, 'video', codec, None, (), '', width, height, pixFmt, frameRate, timeBase,
+                                                      None, None, None, None, videoProfile, level, fieldOrder), profile))
+        elif (it[0] == 'audio'):
+            encodings.append(audio_encoding(it[1], it[5]))
+        else:
+            encodings.append(('copy', []))
+    return encodings
+
+
+def match_streams(signature, target):
+    """The index of the stream of the signature matching each stream of the target signature (by type and order)
+    - None if the signature doesn't have the streams needed.
+    """
+    indices = {}
+    for index, it in enumerate(signature):
+        indices.setdefault(it[0], []).append(index)
+    matched = []
+    used = {}
+    for it in target:
+        available = indices.get(it[0], [])
+        if (used.get(it[0], 0) >= len(available)):
+            return None
+        matched.append(available[used.get(it[0], 0)])
+        used[it[0]] = used.get(it[0], 0) + 1
+    return matched
+
+
+def unencodable(signature, target, profile=None):
+    """The streams of the target signature (described) that the input with the signature would need re-encoded to
+    but no encoder can match (see signature_encodings).
+    """
+    matched = match_streams(signature, target) or []
+    return [describe_signature((it,)) for index, it, encoding in zip(matched, target, signature_encodings(target, profile))
+            if encoding is None and signature[index] != it]
+
+
+def normalize_command(input, output, signature, target, profile=None, threads=None):
+    """Builds the ffmpeg command re-encoding the input (whose streams have the given signature) so its
+    streams match the target signature - the streams differing are encoded like the target (see signature_encodings)
+    at the quality of the encode profile, the others are copied. The streams are matched by type and order.
+
+    Returns None if the input doesn't have the streams needed, or if a stream needed cannot be encoded (see unencodable).
+    """
+    matched = match_streams(signature, target)
+    if (matched is None or unencodable(signature, target, profile)):
+        return None
+    cmd = ['ffmpeg', '-y', '-i', input]
+    for position, (index, it, encoding) in enumerate(zip(matched, target, signature_encodings(target, profile))):
+        kind = it[0]
+        cmd += ['-map', '0:{}'.format(index)]
+        if (signature[index] == it):
+            cmd += ['-c:{}'.format(position), 'copy']
+            continue
+        codec, options = encoding
+        cmd += ['-c:{}'.format(position), codec]
+        #the encoder options apply to this stream only
+        for name, value in zip(options[::2], options[1::2]):
+            cmd += ['{}:{}'.format(name.split(':')[0], position), value]
+        if (kind == 'video'):
+            _, _, width, height, _, frameRate, timeBase = it[:7]
+            if (width and height):
+                cmd += ['-s:{}'.format(position), '{}x{}'.format(width, height)]
+            if (frameRate):
+                cmd += ['-r:{}'.format(position), frameRate]
+            if (timeBase and '/' in timeBase and os.path.splitext(output)[1].lower() in ['.mp4', '.m4v', '.mov']):
+                # only the mp4/mov muxer lets the timebase be set
+                cmd += ['-video_track_timescale', timeBase.split('/')[1]]
+        elif (kind == 'audio'):
+            _, _, sampleRate, channels, _, _ = it
+            if (sampleRate):
+                cmd += ['-ar:{}'.format(position), str(sampleRate)]
+            if (channels):
+                cmd += ['-ac:{}'.format(position), str(channels)]
+    if (threads):
+        cmd += ['-threads', str(threads)]
+    cmd.append(output)
+    return cmd
+
+
+def preflight(inputs, folder, args, cache=None):
+    """Checks that the inputs can be concatenated without re-encoding: the inputs are probed (concurrently)
+    and grouped by stream signature, and the inputs not matching the majority are re-encoded (in parallel -
+    args.jobs at once, default all of them up to the number of CPUs - into folder) to match it. The result is printed (and with --dryrun the re-encoding is only printed).
+
+    Returns the exit code (0 on success, 3 if probing or re-encoding failed) and the list of files to concatenate.
+    """
+    probes = probe_all(inputs, 'json', cache)
+    signatures = []
+    for input in inputs:
+        code, probeOutput = probes[input]
+        if (code > 0):
+            print("Error: '{}' returned exit code '{}' while '0' was expected".format(probe_command(input, 'json'), code), file=sys.stderr)
+            return (3, inputs)
+        signatures.append(stream_signature(parse_probe_json(probeOutput)))
+    target = majority_signature(signatures)
+    print("Pre-flight ({} input(s) match {}):".format(signatures.count(target), describe_signature(target)))
+    jobs = max(1, args.jobs or min(len(signatures) - signatures.count(target), os.cpu_count() or 1))
+    threads = threads_per_job(jobs) if jobs > 1 else None
+    files = []
+    unmatched = set()
+    commands = []
+    for index, (input, signature) in enumerate(zip(inputs, signatures)):
+        if (signature == target):
+            print("  ok.......: {}".format(input))
+            files.append(input)
+            continue
+        missing = unencodable(signature, target, args.profile)
+        if (missing):
+            print("  cannot...: {} ({}) - no encoder for {}".format(input, describe_signature(signature), ', '.join(missing)))
+            unmatched.update(missing)
+            continue
+        print("  normalize: {} ({})".format(input, describe_signature(signature)))
+        _, ext = os.path.splitext(input)
+        normalized = os.path.join(folder, 'normalized{:03d}{}'.format(index, ext))
+        cmd = normalize_command(input, normalized, signature, target, args.profile, threads)
+        if (not cmd):
+            print("Error: '{}' lacks streams needed to match the other inputs".format(input), file=sys.stderr)
+            return (3, inputs)
+        commands.append(cmd)
+        files.append(normalized)
+    if (unmatched):
+        print("Error: no encoder can match {} - the inputs not matching cannot be normalized".format(', '.join(sorted(unmatched))), file=sys.stderr)
+        return (3, inputs)
+    if (args.dryrun):
+        for cmd in commands:
+            print(cmd)
+    elif (commands):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            if ([code for code in pool.map(call, commands) if code > 0]):
+                return (3, inputs)
+    return (0, files)
+
+
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--dryrun", action="store_true",
                         help="Print the commands that would be executed without actually executing them")
-    parser.add_argument("-o", "--output",
-                        help="Output file (extension determines container). If a folder is given output is stored with the input filename in the given folder. If just an extension (e.g. .mkv) is given the input filename with the given extension is used as output (in either the same folder as the input, of if the extension is prefixed with a path in the folder given by the path, e.g. /tmp/.mp4). If prefixed with + the file is relative to the folder of input, e.g. +.mp4 will place a mp4 file in the input folder")
+    parser.add_argument("-o", "--output", action=TargetAction, type=parse_target,
+                        help="Output file (extension determines container). If a folder is given output is stored with the input filename in the given folder. If just an extension (e.g. .mkv) is given the input filename with the given extension is used as output (in either the same folder as the input, of if the extension is prefixed with a path in the folder given by the path, e.g. /tmp/.mp4). If prefixed with + the file is relative to the folder of input, e.g. +.mp4 will place a mp4 file in the input folder. May be given several times to write several outputs from one ffmpeg run (decoding the input once) - each optionally followed by its own codec, profile and scale, e.g. -o /archive/.mkv -o /preview/.mp4,profile=preview,scale=640:-2")
     parser.add_argument("-b", "--begin",
-                        help="If set this marks the time (hh:mm:ss) - in relation to the input - at which to begin the output (default is from the start of input)")
+                        help="If set this marks the time (hh:mm:ss[.fff]) - in relation to the input - at which to begin the output (default is from the start of input)")
     parser.add_argument("-e", "--end",
-                        help="If set this marks the time (hh:mm:ss) - in relation to the input - at which to end the output (default is until the end of input)")
+                        help="If set this marks the time (hh:mm:ss[.fff]) - in relation to the input - at which to end the output (default is until the end of input)")
     parser.add_argument("-v", "--video", type=int,
                         help="If given it is the index of the video stream (counting from 0)")
     parser.add_argument("-a", "--audio", type=int,
@@ -162,63 +2391,156 @@ if __name__ == '__main__':
                         help="If given video stream will be encoded with h264, otherwise it will just be copied (as all other streams)")
     parser.add_argument("-c", "--concat", action="store_true",
                         help="If given the videos listed will be concatenated into one output video - if no output file is given then a file 'concat' with appropriate extension (taken from input) is created")
+    parser.add_argument("--no-preflight", action="store_true",
+                        help="Concatenate right away instead of first checking that the inputs share codecs, resolution, timebase and audio layout (and re-encoding the ones that don't match the majority)")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Number of inputs to recode at once (default 1 - or with --concat one per clip re-encoded, up to the number of CPUs). The CPU threads are split evenly between the jobs, and the exit code reflects all inputs rather than stopping at the first failing one")
+    parser.add_argument("--device-jobs", type=int, metavar='N',
+                        help="Max copy jobs (no video transcoding - bound by the disks, not the CPU) reading from or writing to the same device at once (default is no limit besides --jobs). Use 1 for recordings on a spinning disk")
+    parser.add_argument("--scratch", metavar='DIR',
+                        help="Folder (on a fast local disk) ffmpeg writes to - the output is moved in place once done. Before each job it is checked that both the scratch folder and the folder of the output have room for it")
+    parser.add_argument("-p", "--profile",
+                        help="Encode profile used when transcoding - one of " + ', '.join(sorted(PROFILES)) + " or a profile from the config file (default is 'default', which leaves the settings to ffmpeg)")
+    parser.add_argument("--config",
+                        help="JSON config file with encode profiles (default is ~/.config/recoder/config.json if it exists)")
+    parser.add_argument("--auto-tune", action="store_true",
+                        help="Encode a few short samples of the input with each preset and use the fastest preset meeting --target-bitrate or --max-size")
+    parser.add_argument("--target-bitrate", type=float, metavar="KBITS",
+                        help="Video bitrate (kbits/s) --auto-tune must stay within")
+    parser.add_argument("--max-size", type=float, metavar="MB",
+                        help="Size (MB) of the output --auto-tune must stay within (used if no --target-bitrate is given)")
+    parser.add_argument("--smart-cut", action="store_true",
+                        help="Trim to --begin/--end accurately without re-encoding everything: only the partial GOPs at the start and end are encoded, the rest is copied (applies when not transcoding)")
+    parser.add_argument("--split-parallel", type=int, default=1, metavar="N",
+                        help="Cut each input at keyframes into N chunks which are encoded in parallel and then joined (without re-encoding) into the output - speeds up transcoding a single long recording")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip inputs whose output exists, is newer than the input and has the expected duration - e.g. to restart a batch that died halfway")
+    parser.add_argument("--journal",
+                        help="File the state of each job is logged to as JSON lines (default is ~/.cache/recoder/journal.jsonl)")
+    parser.add_argument("--metrics",
+                        help="File the performance of each job (wall and CPU time, speed, fps, bitrate, sizes and durations) is appended to as JSON lines")
+    parser.add_argument("--prometheus",
+                        help="Prometheus (node exporter) textfile the job metrics are summed up in per codec and container")
+    parser.add_argument("-w", "--watch", metavar="DIR",
+                        help="Keep watching the folder for new files (matching --pattern) and recode each of them once it has been written - runs until interrupted")
+    parser.add_argument("--pattern", default="*.m2t",
+                        help="Files picked up by --watch (default *.m2t)")
+    parser.add_argument("--settle", type=float, default=30,
+                        help="Seconds the size of a file must be unchanged before --watch recodes it (default 30)")
+    parser.add_argument("--queue", choices=['newest', 'shortest'], default='newest',
+                        help="Order in which --watch recodes the files ready - newest first (default) or shortest first")
+    parser.add_argument("--poll", action="store_true",
+                        help="Make --watch list the folder every second instead of using inotify")
+    parser.add_argument("--stream", choices=['fmp4', 'hls', 'dash'],
+                        help="Write the output so it can be read while it is encoded - fmp4 is fragmented MP4 (to a file, a pipe or stdout with -o -), hls and dash write segments and a playlist into a folder named after the output (e.g. -o /srv/preview/ gives /srv/preview/clip/index.m3u8). Subtitles are left out")
+    parser.add_argument("--progress-pipe", action="store_true",
+                        help="Read progress from ffmpeg's machine readable -progress output instead of parsing its stderr (cheaper on long jobs)")
+    parser.add_argument("--probe", choices=['json', 'text'], default='json',
+                        help="How ffprobe output is read - json (default) asks ffprobe for JSON, text parses its human-readable output")
+    parser.add_argument("--rules",
+                        help="JSON file with the rules deciding which streams are suggested by -z (default are the rules in DEFAULT_RULES)")
+    parser.add_argument("--no-probe-cache", action="store_true",
+                        help="Always run ffprobe instead of reusing the probe results cached (in ~/.cache/recoder) for unchanged inputs")
     parser.add_argument("files", nargs='*')
-    args = parser.parse_args()
+    parser.set_defaults(targets=None)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
     
     inputs = args.files
+    try:
+        config = load_config(args.config)
+        args.rules = load_rules(args.rules) if args.rules else None
+        args.profile = find_profile(args.profile, config)
+        if (args.targets):
+            args.targets = [it._replace(profile=find_profile(it.profile, config)) if it.profile else it for it in args.targets]
+    except (OSError, ValueError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 2
     
-    if(not inputs 
-       or (args.streams and not inputs) 
+    if(not (inputs or args.watch)
+       or (args.streams and not (inputs or args.watch))
+       or (args.watch and not args.output)
        or (inputs and not (args.output or args.streams or args.concat))):
         print(parser.format_help())
-        sys.exit(2)
+        return 2
+    if (args.output == '-'):
+        args.stream = args.stream or 'fmp4'
+        if (args.stream != 'fmp4' or args.watch or args.concat or len(inputs) != 1 or len(job_targets(args)) > 1):
+            print("Error: only a single input can be streamed to stdout (as fmp4)", file=sys.stderr)
+            return 2
+    if (args.stream and (args.split_parallel > 1 or args.smart_cut)):
+        print("Error: --stream cannot be combined with --split-parallel or --smart-cut", file=sys.stderr)
+        return 2
+    if (len(job_targets(args)) > 1 and (args.concat or args.split_parallel > 1 or args.smart_cut)):
+        print("Error: several outputs cannot be combined with --concat, --split-parallel or --smart-cut", file=sys.stderr)
+        return 2
 
     if (args.concat):
         # Don't consider other options - just concat the given inputs and copy to one output
-        temp = tempfile.NamedTemporaryFile(prefix="recoder-concat-", suffix=".txt", mode="w+t")
         output, list = concat_list(args.output, inputs)
-        # Write temp file with the files to concatenate
-        for it in list:
-            temp.write(it+'\n')
-        temp.flush()
-        # Give the file til ffmpeg
-        cmd = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', temp.name, '-c', 'copy', output]
-        if(args.dryrun):
-            print("Concatenating:")
-            with open(temp.name,'rt') as f:
-                print(f.read())
-            print("With:")
-            print(cmd)
-        else:
-            proc = subprocess.Popen(cmd,stderr=subprocess.PIPE)
-            for line in proc.stderr:
-               print(line.rstrip().decode('utf-8'))
-            code = proc.wait()
-            if(code > 0):
-                print("Error: '{}' returned exit code '{}' while '0' was expected".format(cmd, code), file=sys.stderr)
-                sys.exit(3)
-        temp.close()
+        folder = tempfile.mkdtemp(prefix="recoder-concat-", dir=os.path.dirname(output) or '.')
+        try:
+            if (len(inputs) > 1 and not args.no_preflight):
+                cache = open_probe_cache(not args.no_probe_cache)
+                try:
+                    code, files = preflight(inputs, folder, args, cache)
+                finally:
+                    if (cache):
+                        cache.close()
+                if (code > 0):
+                    return code
+                _, list = concat_list(args.output, files)
+            temp = tempfile.NamedTemporaryFile(prefix="recoder-concat-", suffix=".txt", mode="w+t")
+            # Write temp file with the files to concatenate
+            for it in list:
+                temp.write(it+'\n')
+            temp.flush()
+            # Give the file til ffmpeg
+            cmd = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', temp.name, '-c', 'copy', output]
+            if(args.dryrun):
+                print("Concatenating:")
+                with open(temp.name,'rt') as f:
+                    print(f.read())
+                print("With:")
+                print(cmd)
+            else:
+                proc = subprocess.Popen(cmd,stderr=subprocess.PIPE)
+                for line in proc.stderr:
+                   print(line.rstrip().decode('utf-8'))
+                code = proc.wait()
+                if(code > 0):
+                    print("Error: '{}' returned exit code '{}' while '0' was expected".format(cmd, code), file=sys.stderr)
+                    return 3
+            temp.close()
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
         
     elif (args.streams and not args.output):
         #Special case - just probe and list the streams...
+        cache = open_probe_cache(not args.no_probe_cache)
+        probes = probe_all(inputs, args.probe, cache)
+        if (cache):
+            cache.close()
         for input in inputs:
             if (len(inputs) > 1):
                 print_name(input)
-            cmd = ['ffprobe']
-            #options are for some detailed output, but getting the error streams holds the relevant info
-            cmd.append(input)
             if (args.dryrun):
-                print(cmd)
-            proc = subprocess.Popen(cmd,stderr=subprocess.PIPE)
-            code = proc.wait()
+                print(probe_command(input, args.probe))
+            code, probeOutput = probes[input]
             if (code > 0):
-                print("Error: '{}' returned exit code '{}' while '0' was expected".format(cmd, code), file=sys.stderr)
-                sys.exit(5)
+                print("Error: '{}' returned exit code '{}' while '0' was expected".format(probe_command(input, args.probe), code), file=sys.stderr)
+                return 5
+            elif (args.probe == 'text'):
+                list = parse_streams(probeOutput, args.dryrun, args.rules)
             else:
-                list = parse_streams(proc.stderr.read().decode('utf-8'), args.dryrun)
-                print('Suggested mapping:')
-                for it in list:
-                    print("{:.<8}: {} {}".format(it['type'],it['index'],'-- ' + it['desc'] if 'desc' in it else ''))
+                list = select_streams(parse_probe_json(probeOutput).streams, args.rules, args.dryrun)
+            print('Suggested mapping:')
+            for it in list:
+                print("{:.<8}: {} {}".format(it['type'],it['index'],'-- ' + it['desc'] if 'desc' in it else ''))
             print('')
             
     else:
@@ -229,114 +2551,33 @@ if __name__ == '__main__':
         elif (args.end):
             period = args.end
 
-        videoCodec = 'h264' if args.transcode else 'copy'
-        for input in inputs:
-            if (len(inputs) > 1):
-                print_name(input)
-            output = output_path(args.output, input)
-            vMap = args.video
-            aMap1 = args.audio
-            aMap2 = None
-            sMap = args.subtitle
-            #if streams probe is requested but all streams are given already skip the probing
-            if (args.streams and not (vMap and aMap1 and sMap)):
-                cmd = ["ffprobe"]
-                #options are for some detailed output, but getting the error streams holds the relevant info
-                cmd.append(input)
-                proc = subprocess.Popen(cmd,stderr=subprocess.PIPE)
-                code = proc.wait()
-                if (code > 0):
-                    print("Error: '{}' returned exit code '{}' while '0' was expected".format(cmd, code), file=sys.stderr)
-                    sys.exit(6)
-                list = parse_streams(proc.stderr.read().decode('utf-8'), False)
-                # we'll consume max one video, two audio and one subtitle - if there are any further they are ignored
-                for it in list:
-                    if(it['type'] == 'video'):
-                        if (not vMap):
-                            vMap = it['index']
-                    elif(it['type'] == 'audio'):
-                        if (not aMap1):
-                            aMap1 = it['index']
-                        elif (not aMap2):
-                            aMap2 = it['index']
-                    elif(it['type'] == 'subtitle'):
-                        if (not sMap):
-                            sMap = it['index']
-
-            #Set up main work (allowing to overwrite existing output)
-            cmd = ["ffmpeg",  "-y"]
-            if (args.begin): 
-                cmd.append("-ss")
-                cmd.append(args.begin)
-            cmd.append("-i")
-            cmd.append(input)
-            if (vMap):
-                cmd.append("-map")
-                cmd.append("0:{}".format(vMap))
-                cmd.append("-vcodec")
-                cmd.append(videoCodec)
-            if (aMap1):
-                cmd.append("-map")
-                cmd.append("0:{}".format(aMap1))
-                cmd.append("-acodec")
-                cmd.append("copy")
-            if (aMap2):
-                 cmd.append("-map")
-                 cmd.append("0:{}".format(aMap2))
-                 cmd.append("-acodec")
-                 cmd.append("copy")
-            if (sMap):
-                 cmd.append("-map")
-                 cmd.append("0:{}".format(sMap))
-                 cmd.append("-scodec")
-                 cmd.append("copy")                 
-            if (period):
-                 cmd.append("-t")
-                 cmd.append(period)
-            cmd.append(output)
-    
-            if (args.dryrun):
-                print(cmd)
-            else:
-                proc = subprocess.Popen(cmd,stderr=subprocess.PIPE)
-                
-                reg = re.compile(r'.*time=([0-9]{2}:[0-9]{2}:[0-9]{2})\.[0-9]{2}.*')
-                dur = re.compile(r'.*Duration: ([0-9]{2}:[0-9]{2}:[0-9]{2})\.[0-9]{2}.*')
-                total = to_seconds(period) if period else None
-                #for bytes in proc.stderr: --- fails since it ignores '\r' as a line termination
-                line=''
-                while True:
-                    b = proc.stderr.read(1)
-                    if not b:
-                        break
-                    else:
-                        ch = b.decode('utf-8')
-                        if ch == '\r' or ch == '\n':
-                            m = reg.match(line)
-                            if(m):
-                                if (total):
-                                    progress = to_seconds(m.group(1))
-                                    percent = progress*100 / total
-                                    print("{:5.1f}% >> {}".format(percent, line), end='\r')
-                                else:
-                                    print(line+'\r')
-                            elif (not total):
-                                m2 = dur.match(line)
-                                if (m2):
-                                    print("Run time: {}".format(m2.group(1)))
-                                    total = to_seconds(m2.group(1))
-                            line=''
-                        else:
-                            line += ch
-                print('')
-    
-                code = proc.wait()
-                proc.stderr.close()
-    
-                if (code > 0):
-                    print("Error: '{}' returned exit code '{}' while '0' was expected".format(cmd, code), file=sys.stderr)
-                    sys.exit(7)
-            print('')
+        cache = open_probe_cache(not args.no_probe_cache and should_probe(args))
+        journal = None
+        if (not args.dryrun):
+            try:
+                journal = Journal(args.journal)
+            except OSError as e:
+                print("Warning: journal not available ({})".format(e), file=sys.stderr)
+        metrics = Metrics(args.metrics, args.prometheus) if args.metrics or args.prometheus else None
+        try:
+            if (args.watch):
+                return watch(args.watch, args, period, cache, journal, metrics)
+            #when the output goes to stdout everything else goes to stderr
+            with contextlib.redirect_stdout(sys.stderr if args.output == '-' else sys.stdout):
+                results = transcode_all(inputs, args, period, cache, journal, metrics)
+        finally:
+            if (cache):
+                cache.close()
+        failed = [(input, code) for input, code in results if code > 0]
+        if (len(inputs) > 1 and failed):
+            print('Failed:', file=sys.stderr)
+            for input, code in failed:
+                print("{}: exit code {}".format(input, code), file=sys.stderr)
+        if (failed):
+            return max(code for _, code in failed)
 
-    sys.exit(0)
-    
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
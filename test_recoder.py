@@ -1,4 +1,4 @@
-import unittest
+import unittest, unittest.mock, asyncio, json, os, sys, tempfile
 import recoder
 
 class TestRecoder(unittest.TestCase):
@@ -40,6 +40,39 @@ Stream #0:2[0x1200]: Subtitle: hdmv_pgs_subtitle ([144][0][0][0] / 0x0090), 1920
         result3 = [{'type':'video', 'index':'0'},{'type':'audio', 'index':'1', 'desc':'ac3 (AC-3 / 0x332D4341), 48000 Hz, stereo, fltp, 256 kb/s'}]
         self.assertEqual(recoder.parse_streams(test3), result3)
 
+        # DVB-T mux with more than 10 streams
+        test4 = '''Stream #0:10[0x1b]: Video: h264 (High), yuv420p, 1920x1080
+Stream #0:11[0x1c](dan): Audio: ac3, 48000 Hz, 5.1(side), fltp, 448 kb/s'''
+        result4 = [{'type':'video', 'index':'10'},{'type':'audio', 'index':'11', 'desc':'ac3, 48000 Hz, 5.1(side), fltp, 448 kb/s'}]
+        self.assertEqual(recoder.parse_streams(test4), result4)
+
+    def test_parse_probe_json(self):
+        # Kaffeine DVB-T recording
+        test1 = json.dumps({'streams': [
+            {'index': 0, 'codec_name': 'h264', 'profile': 'High', 'codec_type': 'video', 'width': 704, 'height': 576, 'pix_fmt': 'yuv420p',
+             'r_frame_rate': '25/1', 'time_base': '1/90000', 'disposition': {'default': 0, 'hearing_impaired': 0}},
+            {'index': 1, 'codec_name': 'aac_latm', 'profile': 'HE-AAC', 'codec_type': 'audio', 'sample_fmt': 'fltp', 'sample_rate': '48000',
+             'channels': 2, 'channel_layout': 'stereo', 'tags': {'language': 'dan'}},
+            {'index': 2, 'codec_name': 'dvb_teletext', 'codec_type': 'subtitle', 'tags': {'language': 'dan'}},
+            {'index': 3, 'codec_name': 'dvb_subtitle', 'codec_type': 'subtitle', 'tags': {'language': 'dan'}},
+            {'index': 4, 'codec_name': 'dvb_subtitle', 'codec_type': 'subtitle', 'disposition': {'hearing_impaired': 1}, 'tags': {'language': 'dan'}},
+            {'index': 12, 'codec_name': 'mp2', 'codec_type': 'audio', 'tags': {'language': 'dan'}}],
+            'format': {'format_name': 'mpegts', 'duration': '3600.120000', 'size': '1234567', 'bit_rate': '2743'}})
+        probe = recoder.parse_probe_json(test1)
+        self.assertEqual(probe.duration, 3600.12)
+        self.assertEqual(probe.format_name, 'mpegts')
+        self.assertEqual(probe.streams[1].channels, 2)
+        self.assertEqual(probe.streams[1].sample_rate, 48000)
+        self.assertEqual(probe.streams[4].disposition, ('hearing_impaired',))
+        result1 = [{'type': 'video', 'index': '0'}, {'type': 'audio', 'desc': 'aac_latm (HE-AAC), 48000 Hz, stereo, fltp', 'index': '1'}, {'type': 'subtitle', 'index': '3'}]
+        self.assertEqual(recoder.select_streams(probe.streams), result1)
+
+        # only English audio, and mp2 is allowed
+        rules = [{'type': 'audio', 'codecs': ['mp2'], 'languages': ['dan']}]
+        self.assertEqual(recoder.select_streams(probe.streams, rules), [{'type': 'audio', 'index': '12'}])
+        # a rules file that cannot be read is an error (exit code 2), not a traceback
+        with unittest.mock.patch('sys.stderr'):
+            self.assertEqual(recoder.main(['-z', '--rules', '/nonexistent/rules.json', 'foo.m2t']), 2)
 
     def test_concat_list(self):
         # concat list with null output
@@ -55,12 +88,406 @@ Stream #0:2[0x1200]: Subtitle: hdmv_pgs_subtitle ([144][0][0][0] / 0x0090), 1920
         self.assertEqual(recoder.to_seconds('05:00'), 300)
         self.assertEqual(recoder.to_seconds('27'), 27)
         self.assertEqual(recoder.to_seconds('01:90'), 60+90)
+        self.assertAlmostEqual(recoder.to_seconds('00:01:02.480'), 62.48)
 
     def test_from_seconds(self):
         self.assertEqual(recoder.from_seconds(3600+300+27), '01:05:27')
         self.assertEqual(recoder.from_seconds(300), '00:05:00')
         self.assertEqual(recoder.from_seconds(27), '00:00:27')
         self.assertEqual(recoder.from_seconds(60+90), '00:02:30') 
-        
+        self.assertEqual(recoder.from_seconds(62.48), '00:01:02.480')
+        self.assertEqual(recoder.from_seconds(recoder.to_seconds('00:01:02.480') - recoder.to_seconds('00:00:02.48')), '00:01:00')
+
+    def test_threads_per_job(self):
+        self.assertEqual(recoder.threads_per_job(4, 32), 8)
+        self.assertEqual(recoder.threads_per_job(3, 32), 10)
+        self.assertEqual(recoder.threads_per_job(8, 4), 1)
+        self.assertEqual(recoder.threads_per_job(0, 4), 4)
+
+    def test_suggest_maps(self):
+        streams = [{'type': 'video', 'index': '0'}, {'type': 'audio', 'index': '1'}, {'type': 'audio', 'index': '2'}, {'type': 'audio', 'index': '3'}, {'type': 'subtitle', 'index': '4'}]
+        self.assertEqual(recoder.suggest_maps(streams), ('0', '1', '2', '4'))
+        self.assertEqual(recoder.suggest_maps(streams, aMap1=3), ('0', 3, '1', '4'))
+        self.assertEqual(recoder.suggest_maps([]), (None, None, None, None))
+
+    def test_ffmpeg_command(self):
+        self.assertEqual(recoder.ffmpeg_command('clip.MTS', 'clip.mkv', ('0', '1', None, None), 'h264'),
+                         ['ffmpeg', '-y', '-i', 'clip.MTS', '-map', '0:0', '-vcodec', 'h264', '-map', '0:1', '-acodec', 'copy', 'clip.mkv'])
+        self.assertEqual(recoder.ffmpeg_command('clip.MTS', 'trimmed.MTS', (None, None, None, None), begin='00:01:00', period='00:04:00', threads=8),
+                         ['ffmpeg', '-y', '-ss', '00:01:00', '-i', 'clip.MTS', '-t', '00:04:00', '-threads', '8', 'trimmed.MTS'])
+
+    def test_progress_parser(self):
+        parser = recoder.ProgressParser()
+        block = b'frame=250\nfps=25.00\nstream_0_0_q=-1.0\nbitrate=3519.0kbits/s\ntotal_size=5250048\nout_time_us=10000000\nout_time_ms=10000000\nout_time=00:00:10.000000\ndup_frames=0\ndrop_frames=0\nspeed=1.25x\nprogress=continue\n'
+        # split in the middle of a line to check that partial lines are kept for the next chunk
+        self.assertEqual(parser.feed(block[:30]), [])
+        result = parser.feed(block[30:] + b'frame=260\nbitrate=N/A\nspeed=N/A\nprogress=end\n')
+        self.assertEqual(result, [recoder.Progress(250, 25.0, 3519.0, 5250048, 10000000, 1.25, False),
+                                  recoder.Progress(260, None, None, None, None, None, True)])
+
+    def test_format_progress(self):
+        progress = recoder.Progress(250, 25.0, 3519.0, 5250048, 10000000, 1.25, False)
+        self.assertEqual(recoder.format_progress(progress, 20),
+                         ' 50.0% >> frame=250 fps=25.0 size=5127kB time=00:00:10.00 bitrate=3519.0kbits/s speed=1.25x')
+        self.assertEqual(recoder.format_progress(progress),
+                         'frame=250 fps=25.0 size=5127kB time=00:00:10.00 bitrate=3519.0kbits/s speed=1.25x')
+
+    def test_probe_cache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            input = os.path.join(folder, 'foo.m2t')
+            with open(input, 'wb') as f:
+                f.write(b'1234')
+            cache = recoder.ProbeCache(os.path.join(folder, 'probe.sqlite'), maxSize=10)
+            self.assertIsNone(cache.get(input, 'json'))
+            cache.put(input, 'json', '{"streams": []}')
+            self.assertEqual(cache.get(input, 'json'), '{"streams": []}')
+            self.assertIsNone(cache.get(input, 'text'))
+            # entries are committed right away, so another recoder sharing the cache sees them (and isn't locked out)
+            other = recoder.ProbeCache(os.path.join(folder, 'probe.sqlite'))
+            self.assertEqual(other.get(input, 'json'), '{"streams": []}')
+            other.put(input, 'text', 'Duration: 00:00:01.00')
+            other.close()
+            # cached results are returned without running ffprobe
+            self.assertEqual(recoder.probe_all([input], 'json', cache), {input: (0, '{"streams": []}')})
+            # changed input is not served from the cache
+            with open(input, 'ab') as f:
+                f.write(b'5')
+            self.assertIsNone(cache.get(input, 'json'))
+            # entries beyond the size bound are evicted
+            cache.put(input, 'json', '{"streams": []}')
+            cache.close()
+            cache = recoder.ProbeCache(os.path.join(folder, 'probe.sqlite'), maxSize=10)
+            self.assertIsNone(cache.get(input, 'json'))
+            cache.close()
+
+    def test_smart_cut_commands(self):
+        video = recoder.parse_probe_json(json.dumps({'streams': [{'index': 0, 'codec_type': 'video', 'codec_name': 'h264', 'profile': 'High',
+                                                                   'level': 40, 'pix_fmt': 'yuv420p', 'field_order': 'tt'}]})).streams[0]
+        codec, options = recoder.matching_encoding(video, {'preset': 'slow', 'crf': 20})
+        self.assertEqual((codec, options), ('libx264', ['-profile:v', 'high', '-pix_fmt', 'yuv420p', '-level', '4.0', '-preset', 'slow',
+                                                        '-crf', '20', '-x264-params', 'tff=1']))
+        mpeg2 = video._replace(codec='mpeg2video', profile='Main', level=8)
+        self.assertEqual(recoder.matching_encoding(mpeg2, {}), ('mpeg2video', ['-profile:v', 'main', '-pix_fmt', 'yuv420p', '-level', '8', '-q:v', '2',
+                                                                                 '-flags', '+ildct+ilme', '-top', '1']))
+        self.assertIsNone(recoder.matching_encoding(video._replace(codec='vc1'), {}))
+        self.assertIsNone(recoder.matching_encoding(video._replace(profile='High 4:4:4 Intra'), {}))
+        self.assertIsNone(recoder.matching_encoding(video._replace(level=None), {}))
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'ffprobe'), 'wt') as f:
+                f.write('#!{}\nprint("0.000000,K_\\n2.000000,K_\\n3.000000,__\\n4.000000,K_")\n'.format(sys.executable))
+            os.chmod(os.path.join(folder, 'ffprobe'), 0o755)
+            path = os.environ['PATH']
+            os.environ['PATH'] = folder + os.pathsep + path
+            args = recoder.build_parser().parse_args(['-d', '--smart-cut', '-b', '00:00:01', '-e', '00:00:05', '-o', os.path.join(folder, 'out.mkv'), 'in.m2t'])
+            args.profile = {}
+            probed = (0, json.dumps({'streams': [{'index': 0, 'codec_type': 'audio', 'codec_name': 'ac3'},
+                                                 {'index': 1, 'codec_type': 'video', 'codec_name': 'h264', 'profile': 'High', 'level': 40,
+                                                  'pix_fmt': 'yuv420p', 'field_order': 'progressive'}], 'format': {'start_time': '0'}}))
+            commands = []
+            try:
+                with unittest.mock.patch('builtins.print', lambda *values, **kwargs: commands.append(values[0])):
+                    code = recoder.recode('in.m2t', os.path.join(folder, 'out.mkv'), args, probed=probed)
+            finally:
+                os.environ['PATH'] = path
+        self.assertEqual(code, 0)
+        # no streams given (no -z, -v or -a) - still mapped, and the codecs are always set
+        encoded = ['-map', '0:1', '-map', '0:a?', '-map', '0:s?', '-c:v', 'libx264', '-profile:v', 'high', '-pix_fmt', 'yuv420p', '-level', '4.0',
+                   '-c:a', 'copy', '-c:s', 'copy']
+        self.assertEqual([it[6:-3] for it in commands[:3]], [encoded, ['-map', '0:1', '-map', '0:a?', '-map', '0:s?', '-c', 'copy'], encoded])
+        self.assertEqual(commands[3][-1], os.path.join(folder, 'out.mkv'))
+
+    def test_split_points(self):
+        self.assertEqual(recoder.split_points(90, 3), [30, 60])
+        self.assertEqual(recoder.split_points(90, 1), [])
+
+    def test_chunk_maps(self):
+        self.assertEqual(recoder.chunk_maps(('0', '1', None, '3')), ('0', '1', None, '2'))
+        self.assertEqual(recoder.chunk_maps((None, '4', '7', None)), (None, '0', '1', None))
+
+    def test_segment_command(self):
+        self.assertEqual(recoder.segment_command('foo.m2t', '/tmp/chunk%03d.mkv', ('0', '1', None, '3'), [30, 60.5], '00:01:00', '00:01:30'),
+                         ['ffmpeg', '-y', '-ss', '00:01:00', '-i', 'foo.m2t', '-map', '0:0', '-map', '0:1', '-map', '0:3', '-t', '00:01:30',
+                          '-c', 'copy', '-f', 'segment', '-segment_times', '30.000,60.500', '-reset_timestamps', '1', '/tmp/chunk%03d.mkv'])
+
+    def test_parse_keyframes(self):
+        output = '''1000.040000,K_
+1000.080000,__
+1002.040000,K_
+N/A,__
+'''
+        self.assertEqual(recoder.parse_keyframes(output), [1000.04, 1002.04])
+        self.assertEqual([round(it, 3) for it in recoder.parse_keyframes(output, 1000)], [0.04, 2.04])
+
+    def test_split_commands(self):
+        with tempfile.TemporaryDirectory() as folder:
+            args = recoder.build_parser().parse_args(['-d', '-x', '--split-parallel', '4', '-o', os.path.join(folder, 'out.mkv'), 'in.m2t'])
+            commands = []
+            with unittest.mock.patch('builtins.print', lambda *values, **kwargs: commands.append(values[0])):
+                code = recoder.transcode_split('in.m2t', os.path.join(folder, 'out.mkv'), ('0', '1', None, None), 'h264', args, 3600)
+        self.assertEqual(code, 0)
+        self.assertEqual(len(commands), 6)
+        # the chunks are cut at keyframes after the split points, so they must be encoded to their end
+        for cmd in commands[1:5]:
+            self.assertNotIn('-t', cmd)
+            self.assertEqual(cmd[cmd.index('-vcodec') + 1], 'h264')
+
+    def test_smart_cut_plan(self):
+        keyframes = [0, 2, 4, 6, 8, 10]
+        self.assertEqual(recoder.smart_cut_plan(1.5, 8.5, keyframes), [(1.5, 2, False), (2, 8, True), (8, 8.5, False)])
+        self.assertEqual(recoder.smart_cut_plan(2, 8, keyframes), [(2, 8, True)])
+        self.assertEqual(recoder.smart_cut_plan(2.5, None, keyframes), [(2.5, 4, False), (4, None, True)])
+        # no complete GOP within the period - everything is encoded
+        self.assertEqual(recoder.smart_cut_plan(2.5, 3.5, keyframes), [(2.5, 3.5, False)])
+        self.assertEqual(recoder.smart_cut_plan(2.5, 4.5, keyframes), [(2.5, 4.5, False)])
+
+    def test_partial_path(self):
+        self.assertEqual(recoder.partial_path('/tmp/foo.mkv'), '/tmp/.foo.part.mkv')
+        self.assertEqual(recoder.partial_path('foo.mkv'), '.foo.part.mkv')
+
+    def test_is_done(self):
+        with tempfile.TemporaryDirectory() as folder:
+            input = os.path.join(folder, 'foo.m2t')
+            output = os.path.join(folder, 'foo.mkv')
+            self.assertFalse(recoder.is_done(input, output, 60, 60))
+            for it in [input, output]:
+                with open(it, 'wb') as f:
+                    f.write(b'1234')
+            os.utime(input, (1000, 1000))
+            os.utime(output, (2000, 2000))
+            self.assertTrue(recoder.is_done(input, output, 3600, 3599.5))
+            self.assertTrue(recoder.is_done(input, output, 3600, 3570))
+            self.assertFalse(recoder.is_done(input, output, 3600, 1800))
+            self.assertFalse(recoder.is_done(input, output, None, 1800))
+            # output older than input
+            os.utime(input, (3000, 3000))
+            self.assertFalse(recoder.is_done(input, output, 3600, 3600))
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as folder:
+            journal = recoder.Journal(os.path.join(folder, 'journal.jsonl'))
+            journal.record('/film/foo.m2t', '/tmp/foo.mkv', 'started')
+            journal.record('/film/foo.m2t', '/tmp/foo.mkv', 'failed', 7)
+            with open(journal.path, 'rt') as f:
+                entries = [json.loads(it) for it in f]
+            self.assertEqual([(it['input'], it['output'], it['state'], it.get('code')) for it in entries],
+                             [('/film/foo.m2t', '/tmp/foo.mkv', 'started', None), ('/film/foo.m2t', '/tmp/foo.mkv', 'failed', 7)])
+
+    def test_parse_stats_line(self):
+        self.assertEqual(recoder.parse_stats_line('frame=  299 fps=3.2 q=-1.0 Lsize=    5127kB time=00:00:11.93 bitrate=3519.0kbits/s speed=0.127x    '),
+                         {'frame': 299, 'fps': 3.2, 'speed': 0.127, 'time': 11.93})
+        self.assertEqual(recoder.parse_stats_line('size=N/A time=00:00:01.00 bitrate=N/A speed=N/A'), {'time': 1})
+
+    def test_job_metrics(self):
+        stats = {'frame': 250, 'fps': 25.0, 'speed': 2.0, 'time': 10.0, 'duration': 3600.0, 'cpu': 12.5}
+        record = recoder.job_metrics('/film/foo.m2t', '/tmp/foo.MKV', 'h264', 0, 5.0, stats, 1250000)
+        self.assertEqual((record['codec'], record['container'], record['code']), ('h264', 'mkv', 0))
+        self.assertEqual((record['wall'], record['cpu'], record['speed'], record['fps']), (5.0, 12.5, 2.0, 50.0))
+        self.assertEqual((record['size'], record['bitrate']), (1250000, 1000.0))
+        self.assertEqual((record['input_duration'], record['output_duration']), (3600.0, 10.0))
+        # speed computed from the duration when ffmpeg didn't report it
+        record = recoder.job_metrics('foo.m2t', 'foo.mkv', 'copy', 7, 4.0, {}, None, 60.0, '00:00:20')
+        self.assertEqual((record['speed'], record['fps'], record['bitrate'], record['output_duration']), (5.0, None, None, 20))
+
+    def test_metrics(self):
+        with tempfile.TemporaryDirectory() as folder:
+            metrics = recoder.Metrics(os.path.join(folder, 'metrics.jsonl'), os.path.join(folder, 'recoder.prom'))
+            metrics.record(recoder.job_metrics('foo.m2t', 'foo.mkv', 'h264', 0, 5.0, {'cpu': 10.0, 'time': 10.0}, 1000))
+            metrics.record(recoder.job_metrics('bar.m2t', 'bar.mkv', 'h264', 0, 3.0, {'cpu': 6.0, 'time': 20.0}, 2000))
+            with open(metrics.path, 'rt') as f:
+                self.assertEqual([json.loads(it)['input'] for it in f], [os.path.abspath('foo.m2t'), os.path.abspath('bar.m2t')])
+            with open(metrics.textfile, 'rt') as f:
+                text = f.read()
+            self.assertIn('recoder_jobs_total{codec="h264",container="mkv",status="ok"} 2', text)
+            self.assertIn('recoder_media_seconds_total{codec="h264",container="mkv",status="ok"} 30.0', text)
+            self.assertIn('recoder_output_bytes_total{codec="h264",container="mkv",status="ok"} 3000', text)
+
+    def test_find_profile(self):
+        self.assertEqual(recoder.find_profile(), {})
+        self.assertEqual(recoder.find_profile('archive'), {'preset': 'slow', 'crf': 20})
+        config = {'profile': 'dvb', 'profiles': {'dvb': {'preset': 'medium', 'bitrate': '2M'}, 'fast': {'preset': 'ultrafast'}}}
+        self.assertEqual(recoder.find_profile(None, config), {'preset': 'medium', 'bitrate': '2M'})
+        self.assertEqual(recoder.find_profile('fast', config), {'preset': 'ultrafast'})
+        self.assertRaises(ValueError, recoder.find_profile, 'unknown')
+
+    def test_profile_options(self):
+        self.assertEqual(recoder.profile_options({}), [])
+        self.assertEqual(recoder.profile_options({'vcodec': 'libx265', 'preset': 'slow', 'crf': 20, 'tune': 'film', 'threads': 4}),
+                         ['-preset', 'slow', '-crf', '20', '-tune', 'film', '-threads', '4'])
+        self.assertEqual(recoder.ffmpeg_command('clip.MTS', 'clip.mkv', ('0', '1', None, None), 'h264', videoOptions=['-preset', 'slow']),
+                         ['ffmpeg', '-y', '-i', 'clip.MTS', '-map', '0:0', '-vcodec', 'h264', '-preset', 'slow', '-map', '0:1', '-acodec', 'copy', 'clip.mkv'])
+        self.assertEqual(recoder.without_option(['-preset', 'slow', '-crf', '20'], '-preset'), ['-crf', '20'])
+
+    def test_pick_preset(self):
+        results = [('ultrafast', 1.0, 6000), ('veryfast', 2.0, 3500), ('fast', 4.0, 3000), ('slow', 9.0, 2600)]
+        self.assertEqual(recoder.pick_preset(results, 4000), 'veryfast')
+        self.assertEqual(recoder.pick_preset(results, 2800), 'slow')
+        self.assertEqual(recoder.pick_preset(results, 2000), 'slow')
+        self.assertEqual(recoder.sample_points(100, 3, 10), [20, 45, 70])
+        self.assertEqual(recoder.sample_points(20, 3, 10), [0])
+        # the CPU time of the samples counts for the job
+        def call(cmd, stats=None):
+            open(cmd[-1], 'wb').close()
+            stats['cpu'] = stats.get('cpu', 0) + 0.5
+            return 0
+        stats = {}
+        with unittest.mock.patch('recoder.call', call), unittest.mock.patch('sys.stdout'):
+            recoder.auto_tune('in.m2t', '0', 'h264', [], 100, 4000, stats=stats)
+        self.assertEqual(stats['cpu'], 0.5 * 3 * len(recoder.AUTO_TUNE_PRESETS))
+
+    def test_stability_tracker(self):
+        tracker = recoder.StabilityTracker(30)
+        tracker.update('/rec/foo.m2t', 1000, 0)
+        tracker.update('/rec/empty.m2t', 0, 0)
+        self.assertEqual(tracker.stable(20), [])
+        tracker.update('/rec/foo.m2t', 2000, 20)
+        self.assertEqual(tracker.stable(40), [])
+        tracker.update('/rec/foo.m2t', 2000, 45)
+        self.assertEqual(tracker.stable(50), ['/rec/foo.m2t'])
+        self.assertEqual(tracker.stable(100), [])
+        self.assertEqual(list(tracker.pending), ['/rec/empty.m2t'])
+
+    def test_queue_priority(self):
+        self.assertLess(recoder.queue_priority('newest', 2000, 10), recoder.queue_priority('newest', 1000, 5))
+        self.assertLess(recoder.queue_priority('shortest', 2000, 10, 60.0), recoder.queue_priority('shortest', 1000, 5, 3600.0))
+        self.assertLess(recoder.queue_priority('shortest', 2000, 5), recoder.queue_priority('shortest', 1000, 10))
+
+    def test_polling_watcher(self):
+        with tempfile.TemporaryDirectory() as folder:
+            watcher = recoder.PollingWatcher(folder)
+            open(os.path.join(folder, 'foo.m2t'), 'wb').close()
+            self.assertEqual(watcher.changes(0), {os.path.join(folder, 'foo.m2t')})
+            # files gone are reported once, so they can be picked up again when recreated
+            os.remove(os.path.join(folder, 'foo.m2t'))
+            self.assertEqual(watcher.changes(0), {os.path.join(folder, 'foo.m2t')})
+            self.assertEqual(watcher.changes(0), set())
+            watcher.close()
+
+    def test_preflight_signatures(self):
+        def probe(width, layout='stereo', subtitle=True, audio='ac3'):
+            streams = [recoder.Stream(0, 'video', 'h264', None, (), '', width, 1080, 'yuv420p', '25/1', '1/90000', None, None, None, None, 'High', 40, 'progressive'),
+                       recoder.Stream(1, 'audio', audio, None, (), '', None, None, None, None, None, 48000, 2, layout, None)]
+            if (subtitle):
+                streams.append(recoder.Stream(2, 'subtitle', 'hdmv_pgs_subtitle', None, (), '', None, None, None, None, None, None, None, None, None))
+            return recoder.Probe(streams, 10.0, 'mpegts', None, None, 0)
+        signatures = [recoder.stream_signature(it) for it in [probe(1920), probe(1440), probe(1920)]]
+        self.assertEqual(signatures[0], (('video', 'h264', 1920, 1080, 'yuv420p', '25/1', '1/90000', 'High', 40, 'progressive'),
+                                         ('audio', 'ac3', 48000, 2, 'stereo', None), ('subtitle', 'hdmv_pgs_subtitle')))
+        target = recoder.majority_signature(signatures)
+        self.assertEqual(target, signatures[0])
+        self.assertEqual(recoder.describe_signature(target), 'h264 (High, level 40) 1920x1080 yuv420p 25/1fps tb 1/90000 | ac3 48000Hz stereo | hdmv_pgs_subtitle')
+        self.assertEqual(recoder.normalize_command('odd.mp4', '/tmp/n.mp4', signatures[1], target, {'preset': 'slow', 'crf': 20}),
+                         ['ffmpeg', '-y', '-i', 'odd.mp4', '-map', '0:0', '-c:0', 'libx264', '-profile:0', 'high', '-pix_fmt:0', 'yuv420p', '-level:0', '4.0',
+                          '-preset:0', 'slow', '-crf:0', '20', '-s:0', '1920x1080', '-r:0', '25/1', '-video_track_timescale', '90000',
+                          '-map', '0:1', '-c:1', 'copy', '-map', '0:2', '-c:2', 'copy', '/tmp/n.mp4'])
+        self.assertEqual(recoder.normalize_command('odd.mkv', '/tmp/n.mkv', recoder.stream_signature(probe(1920, layout='mono')), target)[4:10],
+                         ['-map', '0:0', '-c:0', 'copy', '-map', '0:1'])
+        # several outliers re-encoded at once split the CPU threads
+        self.assertEqual(recoder.normalize_command('odd.mp4', '/tmp/n.mp4', signatures[1], target, threads=4)[-3:], ['-threads', '4', '/tmp/n.mp4'])
+        # there is no encoder for aac_latm (common in DVB) - fine as long as the audio matches already
+        latm = [recoder.stream_signature(it) for it in [probe(1920, audio='aac_latm'), probe(1440, audio='aac_latm'), probe(1920, 'mono', audio='aac_latm')]]
+        self.assertEqual([it is None for it in recoder.signature_encodings(latm[0])], [False, True, False])
+        self.assertEqual(recoder.unencodable(latm[1], latm[0]), [])
+        self.assertIsNotNone(recoder.normalize_command('odd.ts', '/tmp/n.ts', latm[1], latm[0]))
+        self.assertEqual(recoder.unencodable(latm[2], latm[0]), ['aac_latm 48000Hz stereo'])
+        self.assertIsNone(recoder.normalize_command('odd.ts', '/tmp/n.ts', latm[2], latm[0]))
+        # missing subtitle stream cannot be made up
+        self.assertIsNone(recoder.normalize_command('odd.MTS', '/tmp/n.MTS', recoder.stream_signature(probe(1920, subtitle=False)), target))
+
+    def test_build_command(self):
+        job = recoder.RecodeJob('in.m2t', 'out.mkv', ('0', '1', None, '3'), begin='00:10:00', period='00:30:00')
+        self.assertEqual(recoder.build_command(job), ['ffmpeg', '-y', '-ss', '00:10:00', '-i', 'in.m2t', '-map', '0:0', '-vcodec', 'copy',
+                                                      '-map', '0:1', '-acodec', 'copy', '-map', '0:3', '-scodec', 'copy', '-t', '00:30:00', 'out.mkv'])
+        job = job._replace(video_codec='h264', video_options=['-crf', '23'], begin=None, period=None, progress_pipe=True)
+        self.assertEqual(recoder.build_command(job), ['ffmpeg', '-progress', 'pipe:1', '-nostats', '-y', '-i', 'in.m2t', '-map', '0:0', '-vcodec', 'h264',
+                                                      '-crf', '23', '-map', '0:1', '-acodec', 'copy', '-map', '0:3', '-scodec', 'copy', 'out.mkv'])
+
+    def test_targets(self):
+        target = recoder.parse_target('/preview/.mp4,profile=preview,scale=640:-2')
+        self.assertEqual(target, recoder.Target('/preview/.mp4', None, 'preview', '640:-2'))
+        self.assertEqual(recoder.parse_target('/a,b/.mkv'), recoder.Target('/a,b/.mkv'))
+        self.assertRaises(ValueError, recoder.parse_target, '/preview/.mp4,scael=640:-2')
+        args = recoder.build_parser().parse_args(['-o', '/archive/.mkv', '-o', '/preview/.mp4,codec=h264,scale=640:-2', 'in.m2t'])
+        self.assertEqual(args.output, '/archive/.mkv')
+        self.assertEqual(recoder.video_encoding(args), ('copy', []))
+        codec, options = recoder.video_encoding(args, args.targets[1]._replace(profile={'vcodec': 'h264'}))
+        self.assertEqual((codec, options[-2:]), ('h264', ['-vf', 'scale=640:-2']))
+        # a profile alone does not transcode - only -x does
+        args = recoder.build_parser().parse_args(['-p', 'archive', '-o', 'a.mkv', 'in.m2t'])
+        args.profile = recoder.find_profile(args.profile)
+        self.assertEqual(recoder.video_encoding(args), ('copy', []))
+        args.transcode = True
+        self.assertEqual(recoder.video_encoding(args), ('h264', recoder.profile_options({'preset': 'slow', 'crf': 20})))
+        job = recoder.RecodeJob('in.m2t', 'out.mkv', ('0', '1', None, None),
+                                renditions=(recoder.Rendition('out.mp4', 'h264', ['-vf', 'scale=640:-2']),))
+        self.assertEqual(recoder.build_command(job), ['ffmpeg', '-y', '-i', 'in.m2t', '-map', '0:0', '-vcodec', 'copy', '-map', '0:1', '-acodec', 'copy',
+                                                      'out.mkv', '-map', '0:0', '-vcodec', 'h264', '-vf', 'scale=640:-2', '-map', '0:1', '-acodec', 'copy',
+                                                      'out.mp4'])
+
+    def test_run_jobs(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, 'ffmpeg'), 'wt') as f:
+                f.write('#!{}\nimport sys\nsys.stderr.write("  Duration: 00:00:10.00, start: 0\\nframe=250 fps=25 time=00:00:05.00 speed=2x\\r")\n'
+                        'sys.exit(1 if "bad" in sys.argv[-1] else 0)\n'.format(sys.executable))
+            os.chmod(os.path.join(folder, 'ffmpeg'), 0o755)
+            path = os.environ['PATH']
+            os.environ['PATH'] = folder + os.pathsep + path
+            async def collect(jobs):
+                return [event async for event in recoder.run_jobs(jobs, 2)]
+            # the outputs are committed (finish) while the job still holds its device, so copy jobs to one device don't overlap
+            order = []
+            def finish(result):
+                order.append('finish ' + result.job.input)
+                return 5
+            async def serialized(jobs):
+                async for event in recoder.run_jobs(jobs, 2, 1, finish=finish):
+                    if (isinstance(event, recoder.JobStarted)):
+                        order.append('start ' + event.job.input)
+                    elif (isinstance(event, recoder.JobResult)):
+                        self.assertEqual(event.code, 5)
+            try:
+                events = asyncio.run(collect([recoder.RecodeJob('good.m2t', 'good.mkv'), recoder.RecodeJob('bad.m2t', 'bad.mkv')]))
+                asyncio.run(serialized([recoder.RecodeJob('a.m2t', os.path.join(folder, 'a.mkv')), recoder.RecodeJob('b.m2t', os.path.join(folder, 'b.mkv'))]))
+            finally:
+                os.environ['PATH'] = path
+        self.assertEqual(order, ['start a.m2t', 'finish a.m2t', 'start b.m2t', 'finish b.m2t'])
+        for input, code in [('good.m2t', 0), ('bad.m2t', 1)]:
+            kinds = [type(it).__name__ for it in events if it.job.input == input]
+            self.assertEqual(kinds, ['JobStarted', 'DurationEvent', 'ProgressEvent', 'JobResult'])
+            progress = [it for it in events if it.job.input == input and isinstance(it, recoder.ProgressEvent)][0]
+            self.assertEqual((progress.progress.frame, progress.progress.out_time_us, progress.percent), (250, 5000000, 50.0))
+            result = [it for it in events if it.job.input == input][-1]
+            self.assertEqual(result.code, code)
+            self.assertEqual((result.stats['duration'], result.stats['speed'], result.stats['time']), (10.0, 2.0, 5.0))
+
+    def test_stream_output(self):
+        self.assertEqual(recoder.output_path('/srv/preview/', '/rec/foo.m2t', 'index.m3u8'), '/srv/preview/foo/index.m3u8')
+        self.assertEqual(recoder.output_path('.m3u8', '/rec/foo.m2t', 'index.m3u8'), '/rec/foo/index.m3u8')
+        self.assertEqual(recoder.output_path('-', '/rec/foo.m2t'), '-')
+        self.assertEqual(recoder.stream_options('fmp4', '-'), ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof'])
+        self.assertIn('/srv/preview/foo/segment%05d.ts', recoder.stream_options('hls', '/srv/preview/foo/index.m3u8'))
+        self.assertIsNone(recoder.stream_options(None, 'foo.mkv'))
+        job = recoder.RecodeJob('foo.m2t', '-', ('0', '1', None, None), progress_pipe=True, output_options=['-f', 'mp4'])
+        self.assertEqual(recoder.build_command(job, 5), ['ffmpeg', '-progress', 'pipe:5', '-nostats', '-y', '-i', 'foo.m2t', '-map', '0:0', '-vcodec', 'copy',
+                                                         '-map', '0:1', '-acodec', 'copy', '-f', 'mp4', '-'])
+
+    def test_io_scheduling(self):
+        self.assertTrue(recoder.io_bound(recoder.RecodeJob('foo.m2t', 'foo.mkv', ('0', '1', None, None))))
+        self.assertFalse(recoder.io_bound(recoder.RecodeJob('foo.m2t', 'foo.mkv', ('0', '1', None, None), 'h264')))
+        self.assertTrue(recoder.io_bound(recoder.RecodeJob('foo.m2t', 'foo.mka', (None, '1', None, None), 'h264')))
+        with tempfile.TemporaryDirectory() as folder:
+            input = os.path.join(folder, 'foo.m2t')
+            with open(input, 'wb') as f:
+                f.write(b'x' * 1000)
+            self.assertEqual(recoder.job_devices(recoder.RecodeJob(input, os.path.join(folder, 'foo.mkv'))), [os.stat(folder).st_dev])
+            self.assertEqual(recoder.job_devices(recoder.RecodeJob(input + '.missing', '-')), [])
+            # with a scratch folder the device the output is moved to counts as well
+            self.assertEqual(recoder.job_devices(recoder.RecodeJob(input + '.missing', '-', destinations=(os.path.join(folder, 'foo.mkv'),))),
+                             [os.stat(folder).st_dev])
+            self.assertEqual(recoder.space_needed(input), 1000)
+            self.assertEqual(recoder.space_needed(input, '00:00:30', 60.0), 500)
+        staged = recoder.scratch_path('/archive/foo.mkv', '/scratch')
+        self.assertTrue(staged.startswith('/scratch/') and staged.endswith('.foo.part.mkv'))
+        self.assertNotEqual(staged, recoder.scratch_path('/archive/other/foo.mkv', '/scratch'))
+
 if __name__ == '__main__':
     unittest.main()